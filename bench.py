@@ -0,0 +1,141 @@
+# benchmarks of the dependency manager module
+import depman
+import depmcsr
+import gc
+import sys
+import time
+import random
+
+# Functions
+def simple_tree(n):
+	'''Build a simple tree, each node depends on the previous three'''
+
+	nodes = list()
+	for i in range(n):
+		nodes.append(depman.Node(None,nodes[max(i-3,0):i]))
+
+	return nodes, [nodes[-1]]
+
+def wide_tree(n):
+	'''Build a wide tree, a single node depends on n-1 root nodes'''
+
+	nodes = [depman.Node(None) for i in range(n-1)]
+	nodes.append(depman.Node(None,nodes[:]))
+
+	return nodes, [nodes[-1]]
+
+def random_tree(n):
+	'''Build a random tree, each node depends on up to 4 previous nodes'''
+
+	random.seed(0)
+	nodes = list()
+	for i in range(n):
+		l = min(i, random.randrange(5))
+		nodes.append(depman.Node(None,[nodes[random.randrange(i)] 
+			for x in range(l)]))
+
+	return nodes, nodes[-100:]
+
+def bench_traverse(max_n):
+	'''Time _traverse on trees of increasing size'''
+
+	print 'Traversal'
+	print '%-8s %10s %10s %10s %12s' % ('tree', 'nodes', 'edges', 
+		'time [s]', 'us/node')
+	for build in [simple_tree, wide_tree, random_tree]:
+		n = 1000
+		while n <= max_n:
+			nodes, targets = build(n)
+
+			t0 = time.time()
+			trv = depman._traverse(targets)
+			dt = time.time() - t0
+
+			edges = sum([len(x.parents) for x in trv])
+
+			print '%-8s %10d %10d %10.3f %12.3f' % (build.__name__[:-5], 
+				len(trv), edges, dt, 1e6*dt/len(trv))
+
+			# NOTE: the nodes are kept by the default graph otherwise
+			del nodes, targets, trv
+			depman.default_graph.clear()
+			n = n * 10
+
+def rss():
+	'''Return the resident set size of the process in bytes'''
+
+	return int(open('/proc/self/statm').read().split()[1]) * 4096
+
+def bench_memory(n, k=4):
+	'''
+	Measure the memory used by n nodes without edges, and by n nodes which 
+	depend on the previous k each, in bytes per node and per edge
+	'''
+
+	print 'Memory'
+	gc.collect()
+	m0 = rss()
+	graph = depman.Graph()
+	nodes = [depman.Node(None, graph=graph) for i in xrange(n)]
+	gc.collect()
+	per_node = (rss() - m0) / float(n)
+
+	# NOTE: the first graph is kept, so that its memory is not reused
+	m0 = rss()
+	graph2 = depman.Graph()
+	nodes2 = list()
+	for i in xrange(n):
+		nodes2.append(depman.Node(None, nodes2[max(i-k,0):i], graph=graph2))
+	gc.collect()
+	edges = len(graph2._pidx)
+	per_edge = (rss() - m0 - per_node*n) / edges
+	del nodes, graph, nodes2, graph2
+
+	print '%10s %10s %12s %12s' % ('nodes', 'edges', 'B/node', 'B/edge')
+	print '%10d %10d %12.1f %12.1f' % (n, edges, per_node, per_edge)
+
+def bench_csr(max_n, k=4):
+	'''
+	Time building a CSR graph of nodes which depend on k random previous 
+	nodes each, along with its bulk operations, for increasing sizes
+	'''
+
+	print 'CSR graph'
+	if depmcsr.numpy is None:
+		print 'numpy not installed'
+		return
+
+	numpy = depmcsr.numpy
+	numpy.random.seed(0)
+	print '%10s %10s %10s %10s %10s %10s' % ('nodes', 'edges', 'build [s]', 
+		'levels [s]', 'dirty [s]', 'update [s]')
+	n = 1000
+	while n <= max_n:
+		children = numpy.repeat(numpy.arange(1, n), k)
+		parents = (numpy.random.random(len(children))*children).astype(int)
+
+		t0 = time.time()
+		graph = depmcsr.CSRGraph.from_edges(n, parents, children)
+		t1 = time.time()
+		graph.levels()
+		t2 = time.time()
+		graph.propagate([n/2])
+		t3 = time.time()
+		graph.update(graph.digests.__getitem__)
+		t4 = time.time()
+
+		print '%10d %10d %10.3f %10.3f %10.3f %10.3f' % (n, len(parents), 
+			t1 - t0, t2 - t1, t3 - t2, t4 - t3)
+
+		del graph, parents, children
+		n = n * 10
+
+# maximum number of nodes can be given in the command line
+max_n = 1000000
+if len(sys.argv) > 1:
+	max_n = int(sys.argv[1])
+
+depman.DEBUG = False
+bench_memory(max_n)
+bench_csr(max_n)
+bench_traverse(max_n)
@@ -71,21 +71,30 @@ itself. This is checked at runtime, traversing the tree upwards and gathering
 the full list of children at each node. [simpler!!]
 '''
 
-import dbm
+import depmdb
+import depmpp
+import depmcache
 import hashlib
 import atexit
-
-# NOTE: Temporary, only used for the sleep function
+import os
+import sys
 import time
+import traceback
+import Queue
+import array
+import threading
+import multiprocessing
+import multiprocessing.pool
+import heapq
+import itertools
+import pickle
 
 ## Metadata
 __author__='Pedro Inácio'
 
 ## Module variables
-# TODO: use efficient store for hash_table
-# 		load at beggining, each node will update it in thread-safe way
-# hash_table = dict()
-hash_table = dbm.open('.depman','c')
+# session used by the module level update, created on first use
+_session = None
 
 # global node counter
 gid = 0
@@ -93,43 +102,75 @@ gid = 0
 # debug flag
 DEBUG = True
 
+# bits of the flags of a node
+_UPDATE_DONE = 1
+_PAYLOAD_DELIVERED = 2
+
+# resources used by a node by default
+_default_resources = {'cpu': 1}
+
 ## Module functions
-def update(nodes):
+def update(nodes, changed=None, keep_going=False, fail_fast=False):
+	'''
+	Bring the requested nodes up to date in the default session, which keeps 
+	the hash table in .depman. See Session.update.
 	'''
-	Traverse the tree requesting nodes to updated themselves until all
-	declare to be updated
+
+	return _default_session().update(nodes, changed, keep_going, fail_fast)
+
+def update_async(nodes, changed=None, keep_going=False, fail_fast=False):
 	'''
+	Start bringing the requested nodes up to date in the default session and
+	return a Build handle. See Session.update_async.
+	'''
+
+	return _default_session().update_async(nodes, changed, keep_going, 
+		fail_fast)
 
-	# traverse
-	trv = _traverse(nodes)
+def _default_session():
+	'''Return the default session, creating it on first use'''
 
-	# check all are up to date
-	while not all([x.is_updated() for x in trv]):
-		[x._trigger_update() for x in trv if not x.is_updated()]
+	global _session
+	if _session is None:
+		_session = Session()
+
+	return _session
 
 def _traverse(nodes):
 	'''
 	Traverse the tree without using recursion. Return list of nodes sorted by 
-	parents first
+	parents first.
+
+	This is an iterative depth-first search over the parents, appending each 
+	node after all its parents. Visited nodes are kept in a set keyed by id(),
+	so the traversal runs in time linear in the number of nodes and edges.
 	'''
 
 	# turn into list if not
 	if not isinstance(nodes,list):
 		nodes = [nodes]
 
-	# make an internal copy of the list
-	q = nodes[:]
-
 	# trv returns a list of nodes parents first
 	trv = []
-	while q:
-		x = q.pop(0)
-		q.extend([y for y in x.parents if y not in q])
-
-		if x in trv:
-			trv.remove(x)
-		# prepend parent at the top
-		trv.insert(0, x)
+	seen = set()
+	for root in nodes:
+		if id(root) in seen:
+			continue
+		seen.add(id(root))
+
+		# stack of nodes along with an iterator over their unvisited parents
+		stack = [(root, iter(root.parents))]
+		while stack:
+			x, it = stack[-1]
+			for y in it:
+				if id(y) not in seen:
+					seen.add(id(y))
+					stack.append((y, iter(y.parents)))
+					break
+			else:
+				# all parents done, append node after them
+				stack.pop()
+				trv.append(x)
 
 	return trv
 
@@ -143,72 +184,1241 @@ def payload(nid):
 	print 'Node ' + nid + ': executing payload ...'
 	return True
 
-def _write_hashes(nid, hsh, parents):
+def _execute(payload, nid):
+	'''
+	Run the payload of a node in the processing pool, return its success, wall
+	time in seconds and the traceback of the exception raised, if any.
+	Exceptions are caught and reported as a failure so that the pool callback,
+	and therefore the scheduler, is always notified.
+	'''
+
+	start = time.time()
+	error = None
+	try:
+		success = bool(payload(nid))
+	except Exception:
+		error = traceback.format_exc()
+		sys.stderr.write(error)
+		success = False
+
+	return success, time.time() - start, error
+
+def _deliver_chunk(nodes, queue):
+	'''
+	Send the payloads of nodes as a single task to the executor of the first 
+	one. Each node is put in queue by its callback as soon as its payload is 
+	done.
+	'''
+
+	for x in nodes:
+		x._queue = queue
+		x._payload_delivered = True
+
+	nodes[0]._pool.apply_batch(_execute, [(x._payload, x.nid) for x in nodes],
+		callback=lambda i, result: nodes[i]._update_callback(result),
+		error_callback=lambda i, error: nodes[i]._error_callback(error))
+
+def _execute_chain(nodes, records):
+	'''
+	Run the payloads of a chain of nodes in the processing pool, each node being
+	the only child of the previous one. The first node is known to need its 
+	payload run. Each following node is checked against its record in the 
+	hash table, as in Node._check_state, with the hashes computed here after 
+	the previous payload ran, and its payload is run only if needed.
+	Return a list with the status ('ran', 'ok' or 'failed'), the wall time and 
+	the hash of each node, or the traceback of the failure if any, which stops 
+	at the first failure.
+	'''
+
+	out = []
+	for i, x in enumerate(nodes):
+		if i > 0:
+			hsh = x.hash()
+			if _compare(x.nid, records[i], hsh, [(nodes[i-1].nid, 
+				out[-1][2])]) == 'ok':
+				out.append(('ok', None, hsh))
+				continue
+
+		success, elapsed, error = _execute(x._payload, x.nid)
+		if not success:
+			out.append(('failed', elapsed, error))
+			break
+
+		out.append(('ran', elapsed, x.hash()))
+
+	return out
+
+def _execute_pickled_chain(data):
+	'''
+	Load a chain of nodes pickled by _deliver_chain and run it, see 
+	_execute_chain.
+
+	NOTE: a task which cannot be loaded by a worker of a multiprocessing pool,
+		  e.g., because a node class was defined after the pool was created,
+		  is dropped by the pool, which then waits for it for ever. Loaded 
+		  here, the failure is raised by the task instead.
+	'''
+
+	return _execute_chain(*pickle.loads(data))
+
+def _sendable(node):
+	'''Return true if a node can be pickled, to run in a chain'''
+
+	try:
+		pickle.dumps(node, pickle.HIGHEST_PROTOCOL)
+	except Exception:
+		return False
+
+	return True
+
+def _deliver_chain(nodes, records, queue, results):
 	'''
-	Write the hash of a node to the database along with its parents
+	Send a chain of nodes as a single task to the executor of the first one, 
+	see _execute_chain. When the task is done, the status of each node is kept 
+	in results, keyed by id(), and the first node is put in queue; the 
+	scheduler takes the status of the next node once it is released.
 	'''
 
-	aux = str(hsh)
-	for item in parents:
-		aux += ',' + item[0] + ',' + item[1]
+	for x in nodes:
+		x._queue = queue
+		x._payload_delivered = True
+
+	def callback(out):
+		for x, (status, elapsed, hsh) in zip(nodes, out):
+			x._elapsed = elapsed
+			if status == 'failed':
+				x._session._hash_cache.pop(x.nid, None)
+				if hsh is not None:
+					x._error = RuntimeError(hsh)
+			else:
+				x._session._hash_cache[x.nid] = hsh
+			results[id(x)] = status
+
+		# NOTE: the first node is put in queue last, so that the status of the
+		#		others is known when they are released
+		queue.put((nodes[0], results.pop(id(nodes[0]))))
+
+	nodes[0]._pool.apply_async(_execute_pickled_chain, 
+		(pickle.dumps((nodes, records), pickle.HIGHEST_PROTOCOL),), 
+		callback=callback, error_callback=nodes[0]._error_callback)
+
+def _compare(nid, record, my_hash, list_parents_now):
+	'''
+	Compare the hash of a node and the list of (nid, hash) of its parents with
+	the record of the node in the hash table, None if missing. Return the state
+	of the node, see Node._check_state.
+	'''
 
-	hash_table[nid] = aux
+	# control variable
+	return_flag = False
 
-def _read_hashes(nid):
-	'''Read the hash and parents info from the hash table'''
+	# check that node exists
+	if record is None:
+		if DEBUG:
+			print 'Node ' + nid + ': _check_state: new'
+		return 'new'
 
-	if nid not in hash_table:
-		return None
-	else:
-		aux = hash_table[nid].split(',')
-		hsh = aux[0]
-		parents = list()
-		for i in range(1,len(aux),2):
-			parents.append(tuple([aux[i],aux[i+1]]))
+	# retrieve data from hash_table
+	prev_hash, list_parents_prev = record
 
-		return hsh, parents
+	# check that node did not change:
+	if my_hash != prev_hash:
+		if DEBUG:
+			print 'Node ' + nid + ': _check_state: changed'
+		return 'changed'
+
+	# check that no previous dependencies are missing
+	for item in [x[0] for x in list_parents_prev]:
+		if item not in [x[0] for x in list_parents_now]:
+			# old dependencies gone
+			if DEBUG:
+				print 'Node ' + nid + ': _check_state: node', item, 'no longer a dependency'
+			return_flag = True
 
-def _close_db():
-	'''Close the db'''
+	# check new dependencies
+	for item in [x[0] for x in list_parents_now]:
+		if item not in [x[0] for x in list_parents_prev]:
+			# new dependencies
+			if DEBUG:
+				print 'Node ' + nid + ': _check_state: node', item, 'is a new dependency'
+			return_flag = True
+
+	if return_flag:
+		return 'parents_number'
+
+	# check the order of the dependencies
+	for i in range(len(list_parents_now)):
+		if list_parents_now[i][0] != list_parents_prev[i][0]:
+			if DEBUG:
+				print 'Node ' + nid + ': _check_state: order of dependencies changed'
+			return 'parents_order'
+
+	# check the hashes
+	# NOTE: up to here we already checked the number and order of the 
+	# 		elements in the list
+	for i in range(len(list_parents_now)):
+		if tuple(list_parents_now[i]) != tuple(list_parents_prev[i]):
+			if DEBUG:
+				print 'Node ' + nid + ': _check_state: ' + list_parents_now[i][0] + ' has changed'
+			return_flag = True
+	
+	if return_flag:		
+		return 'parents_changed'
+
+	# if none of the above apply, then all is good
+	return 'ok'
+
+def _prehash(node):
+	'''
+	Hash a node and its parents, to be run in a thread before the state of the
+	node is checked.
+	'''
+
+	try:
+		node._hash()
+		[x._hash() for x in node.parents]
+	except Exception:
+		# NOTE: the node is hashed again when its state is checked, raising the
+		#		exception in the main thread
+		pass
+
+	return node
+
+def _cache_get(cache, key, node):
+	'''
+	Restore the outputs of a node from the cache, to be run in a thread. Return
+	the node along with true on a hit.
+	'''
 
-	hash_table.close()
+	try:
+		return node, cache.get(key, node.outputs)
+	except Exception:
+		# NOTE: an entry which cannot be restored is a miss, the payload runs
+		traceback.print_exc()
+		return node, False
 
-# tell python to close the db at exit
-atexit.register(_close_db)
+def _cache_put(cache, key, paths):
+	'''Store the outputs of a node in the cache, to be run in a thread'''
+
+	try:
+		cache.put(key, paths)
+	except Exception:
+		traceback.print_exc()
 
 ## Module classes
+class Session(object):
+	"""
+	The Session holds the hash table used to update nodes.
+
+	The hash table is opened at db_path, using the depmdb backend, on first 
+	use and closed at exit or by close(). Writes are buffered and flushed every
+	records records or interval seconds. Nothing is opened when the session is 
+	created, so several sessions with their own hash tables can live in one 
+	process and processing pools created before the first update do not 
+	inherit an open database.
+
+	If hash_jobs is given, nodes are hashed before their state is checked in a 
+	pool of that many threads, so that independent nodes are hashed 
+	concurrently. Otherwise they are hashed one at a time in the main thread.
+
+	resources is a dictionary with the capacity of named resources, e.g., 
+	{'cpu': 8, 'db': 2}. A payload is only sent to the pool while the 
+	resources required by its node are available. Resources not listed are 
+	unlimited, including 'cpu', so that by default the number of payloads 
+	running at once is only bounded by the executors, e.g., the size of their 
+	pools.
+
+	Nodes whose payload last took less than batch seconds are sent to their
+	executor in chunks of about chunk_time seconds, which run in one worker 
+	and share the resources of a single node. Set batch to None to send every
+	payload on its own.
+
+	If fuse is true, linear chains of nodes, where each node is the only parent
+	of the next one and its only child, run back to back as a single task of 
+	their executor. The nodes of a chain after the first one are checked and 
+	hashed in the worker, so their hash must not depend on the session, and 
+	the nodes are pickled when sent to the executor: nodes which cannot be 
+	pickled are not fused, and a chain which cannot be loaded by the worker 
+	fails. Chains only fuse nodes of the same executor and resources.
+
+	cache is an optional depmcache.Cache, or an object with the same get and 
+	put methods. The outputs of the nodes which have any are stored in it once
+	their payload ran, and restored from it, instead of running the payload,
+	when a node with the same action and parent hashes is updated again. The
+	outputs are copied in a pool of threads, while the other nodes run.
+	"""
+	def __init__(self, db_path='.depman', backend='sqlite', records=1000, 
+		interval=1.0, hash_jobs=None, resources=None, batch=0.005, 
+		chunk_time=0.05, fuse=False, cache=None):
+		super(Session, self).__init__()
+
+		self.db_path = db_path
+		self.backend = backend
+		self.records = records
+		self.interval = interval
+		self.hash_jobs = hash_jobs
+
+		self.resources = dict()
+		if resources is not None:
+			self.resources.update(resources)
+
+		self.batch = batch
+		self.chunk_time = chunk_time
+		self.fuse = fuse
+		self.cache = cache
+
+		# store of the node hashes, see the store property
+		self._store = None
+
+		# hashes of the nodes computed during the current update, keyed by 
+		# node id
+		self._hash_cache = dict()
+
+		# events of the hashes being computed, keyed by node id
+		self._hash_events = dict()
+		self._hash_lock = threading.Lock()
+
+		# lock held while an update runs
+		self._running = threading.Lock()
+
+	@property
+	def store(self):
+		'''The store of the node hashes, opened on first use'''
+
+		if self._store is None:
+			self._store = depmdb.WriteBehind(
+				depmdb.open(self.db_path, self.backend), self.records, 
+				self.interval)
+
+			# tell python to close the db at exit
+			atexit.register(self.close)
+
+		return self._store
+
+	def close(self):
+		'''Flush and close the hash table, it is opened again if needed'''
+
+		if self._store is not None:
+			self._store.close()
+			self._store = None
+
+	def update_async(self, nodes, changed=None, keep_going=False, 
+		fail_fast=False):
+		'''
+		Start bringing the requested nodes up to date in the background and 
+		return a Build handle to wait for it. Only one update can run at a time
+		in a session, a RuntimeError is raised if another one is running.
+
+		Payloads waiting on I/O are best run with depmpp.ThreadExecutor, so 
+		that many of them run concurrently without a process each.
+		'''
+
+		self._acquire()
+		try:
+			return Build(self, nodes, changed, keep_going, fail_fast)
+		except Exception:
+			self._running.release()
+			raise
+
+	def _acquire(self):
+		'''Take the session for an update, raise if another one is running'''
+
+		if not self._running.acquire(False):
+			raise RuntimeError('An update is already running in this session')
+
+	def update(self, nodes, changed=None, keep_going=False, fail_fast=False):
+		'''
+		Bring the requested nodes up to date.
+
+		Each node of the traversal keeps a counter of the parents which are not 
+		yet up to date. Nodes without pending parents are dispatched; when a 
+		node is done, the counters of its children are decremented and those 
+		reaching zero are dispatched in turn. The main loop blocks on a queue 
+		of finished nodes, so the work done per finished node is proportional 
+		to its number of children.
+
+		changed is an optional list of nodes known to have changed, e.g., 
+		reported by a file watcher. If given, only the changed nodes and their 
+		descendants are checked; the other nodes are taken as up to date 
+		without hashing them, provided they are already in the hash table.
+		The records of the nodes left out of date by an update, e.g., by a 
+		failure, are dropped from the hash table, so that they are checked 
+		again by the next one.
+
+		If a payload fails, a RuntimeError is raised, unless keep_going is 
+		true: then the failed node and its descendants are blocked and the 
+		other nodes are brought up to date. Return a dictionary with the nid of
+		each failed node along with the list of nids it blocked, which were not
+		blocked already, empty if all went well. The error raised by the 
+		payload or the executor, if any, is kept in the _error attribute of 
+		the failed node. Under keep_going, a node whose hash raises an 
+		exception, e.g., a file node whose file cannot be read, fails likewise;
+		otherwise the exception is raised.
+
+		If fail_fast is true, the first failure also cancels the payloads 
+		delivered to the executors and not done yet, see 
+		depmpp.Executor.cancel, so that the workers are free when the error is
+		raised.
+
+		Only one update can run at a time in a session, a RuntimeError is 
+		raised if another one is running, see update_async.
+		'''
+
+		self._acquire()
+		try:
+			return self._update(nodes, changed, keep_going, fail_fast)
+		finally:
+			self._running.release()
+
+	def _update(self, nodes, changed, keep_going, fail_fast):
+		'''Bring the nodes up to date, see update'''
+
+		if keep_going and fail_fast:
+			raise ValueError('keep_going and fail_fast are exclusive')
+
+		# hashes are computed at most once per update
+		self._hash_cache.clear()
+
+		# traverse
+		trv = _traverse(nodes)
+
+		# the nodes use the hash table of this session
+		store = self.store
+		for x in trv:
+			x._session = self
+
+		# the downstream cone of the changed nodes, found with the child index
+		# NOTE: the cone is checked again even if it was brought up to date by
+		#		an earlier update, as Node.add_parent does
+		dirty = None
+		cone = []
+		if changed is not None:
+			if not isinstance(changed,list):
+				changed = [changed]
+			cone = list(changed)
+			for g in set([x._graph for x in changed]):
+				roots = [y for y in changed if y._graph is g]
+				cone.extend(g.descendants(roots))
+			for x in cone:
+				x._update_done = False
+			dirty = set([id(x) for x in cone])
+
+		# children of each node and number of parents not yet up to date
+		# NOTE: keyed by id() to avoid the string comparisons of Node.__eq__
+		children = dict([(id(x), []) for x in trv])
+		pending = dict()
+		for x in trv:
+			pending[id(x)] = len(x.parents)
+			for y in x.parents:
+				children[id(y)].append(x)
+
+		def release(x):
+			'''Decrement the counters of the children, return the ready ones'''
+
+			ready = []
+			for y in children[id(x)]:
+				pending[id(y)] -= 1
+				if pending[id(y)] == 0:
+					ready.append(y)
+			return ready
+
+		# nodes blocked by a failed parent, keyed by id(), and the nids blocked
+		# by each failed node
+		blocked = set()
+		failures = dict()
+
+		# nodes whose record is out of date unless they are updated, keyed by 
+		# id(): those changed and those whose payload is needed, ran or failed
+		touched = set([id(x) for x in changed or []])
+
+		def block(x):
+			'''Block the descendants of a failed node, return the new ones'''
+
+			out = []
+			q = [x]
+			while q:
+				aux = []
+				for y in q:
+					for z in children[id(y)]:
+						if id(z) not in blocked:
+							blocked.add(id(z))
+							aux.append(z)
+				out.extend(aux)
+				q = aux
+			return out
+
+		# nodes already up to date from a previous call release their children
+		left = 0
+		for x in trv:
+			# a node outside the cone is clean if it is known and its parents 
+			# are clean
+			# NOTE: a parent can be outside the cone but still pending if it is
+			#		a new node, in which case the node has to be checked
+			if dirty is not None and not x.is_updated() and id(x) not in dirty \
+				and all([y.is_updated() for y in x.parents]) and x.nid in store:
+
+				if DEBUG:
+					print 'Node ' + x.nid + ': update: clean'
+
+				x._update_done = True
+
+			if x.is_updated():
+				release(x)
+			else:
+				left += 1
+
+		# queue of nodes along with their status, filled by the nodes, the 
+		# thread pool and the processing pool callbacks. The status is one of
+		#	- 'hashed'	: hashes computed in the thread pool, check the state
+		#	- 'ran'		: payload executed, the node has to be hashed again
+		#	- 'failed'	: payload failed
+		#	- 'ok'		: node ready to be marked as updated
+		#	- 'restored': outputs restored from the cache, as if the payload ran
+		#	- 'missed'	: outputs not in the cache, the payload has to run
+		done = Queue.Queue()
+
+		# pool of threads hashing the nodes before checking their state
+		hasher = None
+		if self.hash_jobs:
+			hasher = multiprocessing.pool.ThreadPool(self.hash_jobs)
+
+		# pool of threads copying the outputs from and to the cache
+		# NOTE: the outputs can be large, so they are not copied in this thread,
+		#		which would hold the dispatch of the other nodes meanwhile
+		copier = None
+		if self.cache is not None and any([x.outputs for x in trv]):
+			copier = multiprocessing.pool.ThreadPool(4)
+
+		# estimated length of the critical path from each node to the targets,
+		# using the recorded wall times of the payloads
+		# NOTE: nodes without history are estimated at the mean recorded time,
+		#		so without any history the nodes are ranked by the length of 
+		#		their longest chain of descendants
+		times = dict([(id(x), store.get_time(x.nid)) for x in trv 
+			if not x.is_updated()])
+		known = [t for t in times.itervalues() if t is not None]
+		guess = sum(known)/len(known) if known else 1.0
+
+		critical = dict()
+		for x in reversed(trv):
+			if not x.is_updated():
+				critical[id(x)] = (times[id(x)] if times[id(x)] is not None 
+					else guess) + max([critical[id(y)] 
+					for y in children[id(x)]] or [0.0])
+
+		# nodes waiting for resources, one heap per set of requirements, 
+		# ordered by longest critical path first, and the resources in use
+		waiting = dict()
+		used = dict([(k, 0) for k in self.resources])
+		count = itertools.count()
+
+		# nodes whose payload took less than self.batch seconds are delivered
+		# in chunks, each chunk sent as a single task to the executor. The 
+		# size of a chunk is chosen so that it takes about self.chunk_time 
+		# seconds, using an estimate of the time of a small payload updated 
+		# as they complete.
+		# NOTE: nodes with a timeout or a retry policy are delivered on their 
+		#		own, so that each payload is timed and retried on its own
+		plain = set([id(x) for x in trv 
+			if x.timeout is None and x.attempts <= 1])
+		small = set([k for k, t in times.iteritems() if self.batch and 
+			t is not None and t < self.batch and k in plain])
+		estimate = [sum([times[k] for k in small])/len(small) if small 
+			else self.batch]
+
+		# resources used by each node delivered, shared by the nodes of a 
+		# chunk, along with the number of nodes still running
+		running = dict()
+
+		# next node of the linear chain starting at each node, if fused, and
+		# the status of the nodes of the chains already run, keyed by id()
+		successor = dict()
+		chained = dict()
+		if self.fuse:
+			for x in trv:
+				if x.is_updated() or len(children[id(x)]) != 1:
+					continue
+				y = children[id(x)][0]
+				if len(y.parents) == 1 and y._pool is x._pool and \
+					y.resources == x.resources and id(x) in plain and \
+					id(y) in plain and (self.cache is None or not y.outputs) \
+					and _sendable(x) and _sendable(y):
+					successor[id(x)] = y
+
+		def required(x):
+			'''Return the resources used by a node, limited to the capacity'''
+
+			# NOTE: a node requiring more than the capacity runs on its own
+			return tuple(sorted([(k, min(n, self.resources[k])) 
+				for k, n in x.resources.iteritems() if k in self.resources]))
+
+		def fits(req):
+			'''Return true if the required resources are available'''
+
+			return all([used[k] + n <= self.resources[k] for k, n in req])
+
+		def admit():
+			'''Deliver the payloads of the waiting nodes while resources last'''
+
+			while True:
+				# the node with the longest critical path among those which fit
+				best = None
+				for req, q in waiting.iteritems():
+					if q and fits(req) and (best is None or q[0] < best[0]):
+						best = (q[0], req)
+
+				if best is None:
+					return
+
+				heap = waiting[best[1]]
+				chunk = [heapq.heappop(heap)[2]]
+
+				# the chain of nodes following the node runs along with it
+				while id(chunk[-1]) in successor:
+					chunk.append(successor[id(chunk[-1])])
+
+				# fill the chunk with the next small nodes of the same executor
+				# NOTE: at most size nodes are set aside, so that admitting a 
+				#		chunk never scans the whole heap
+				if len(chunk) == 1 and id(chunk[0]) in small:
+					size = max(1, min(1000, 
+						int(self.chunk_time/max(estimate[0], 1e-6))))
+					aside = []
+					while heap and len(chunk) < size and len(aside) < size:
+						item = heapq.heappop(heap)
+						if id(item[2]) in small and \
+							item[2]._pool is chunk[0]._pool:
+							chunk.append(item[2])
+						else:
+							aside.append(item)
+					[heapq.heappush(heap, item) for item in aside]
+
+				for k, n in best[1]:
+					used[k] += n
+				record = [best[1], len(chunk)]
+				for x in chunk:
+					running[id(x)] = record
+
+				if len(chunk) == 1:
+					chunk[0]._deliver(done)
+				elif id(chunk[0]) in successor:
+					_deliver_chain(chunk, [None] + [store.get(x.nid) 
+						for x in chunk[1:]], done, chained)
+				else:
+					_deliver_chunk(chunk, done)
+
+		def release_resources(x):
+			'''Free the resources used by a node whose payload is done'''
+
+			record = running.pop(id(x))
+			record[1] -= 1
+			if record[1] == 0:
+				for k, n in record[0]:
+					used[k] -= n
+
+			# update the estimate of the time of the small payloads
+			if id(x) in small and x._elapsed is not None:
+				estimate[0] = 0.9*estimate[0] + 0.1*x._elapsed
+
+		# failed nodes waiting to be retried, ordered by the time of the retry,
+		# and the number of attempts made by each node
+		retries = []
+		attempts = dict()
+
+		def wait():
+			'''Return the time to wait for a node to finish'''
+
+			# NOTE: the wait is at most a second, waiting on a queue without a 
+			#		timeout cannot be interrupted, e.g., by Ctrl-C
+			due = store.due()
+			due = 1.0 if due is None else min(1.0, due)
+			if retries:
+				due = max(0.0, min(retries[0][0] - time.time(), due))
+			return due
+
+		def cancel():
+			'''Cancel the payloads delivered and the hashes queued'''
+
+			pools = dict([(id(y._pool), y._pool) for y in trv 
+				if id(y) in running])
+			for pool in pools.itervalues():
+				pool.cancel()
+
+			if hasher is not None:
+				hasher.terminate()
+
+		def check(x):
+			'''Check the state of a node and dispatch it'''
+
+			# the node already ran in a chain
+			if id(x) in chained:
+				done.put((x, chained.pop(id(x))))
+			elif hasher is None:
+				run(x)
+			else:
+				hasher.apply_async(_prehash, (x,), 
+					callback=lambda y: done.put((y, 'hashed')))
+
+		# cache keys of the nodes whose payload runs, to store their outputs
+		keys = dict()
+
+		def run(x):
+			'''Check the state of a hashed node, queue its payload if needed'''
+
+			try:
+				if not x._trigger_update(done):
+					return
+
+				touched.add(id(x))
+
+				# look the outputs up in the cache first, the node comes back 
+				# as restored or missed
+				if self.cache is not None and x.outputs:
+					key = keys[id(x)] = depmcache.key(x.action(), 
+						[(y.nid, y._hash()) for y in x.parents])
+					copier.apply_async(_cache_get, (self.cache, key, x), 
+						callback=lambda y: done.put((y[0], 
+							'restored' if y[1] else 'missed')))
+					return
+			except Exception:
+				if not keep_going:
+					raise
+				unhashable(x)
+				return
+
+			enqueue(x)
+
+		def unhashable(x):
+			'''Fail a node whose hash raised, without retrying it'''
+
+			# NOTE: the node is then blocked along with its descendants as if 
+			#		its payload failed
+			x._error = RuntimeError(traceback.format_exc())
+			attempts[id(x)] = x.attempts
+			done.put((x, 'failed'))
+
+		def enqueue(x):
+			'''Queue the payload of a node until resources are available'''
+
+			# NOTE: the payloads are delivered by admit(), after the whole wave 
+			#		of nodes is checked so that they are delivered in order
+			heapq.heappush(waiting.setdefault(required(x), []), 
+				(-critical[id(x)], next(count), x))
+
+		# wait for nodes to finish and dispatch their children
+		try:
+			# dispatch the nodes which have no pending parents
+			[check(x) for x in trv 
+				if not x.is_updated() and pending[id(x)] == 0]
+			admit()
+
+			while left:
+				# take the next finished node along with all the others which 
+				# finished meanwhile
+				# NOTE: while waiting, the buffered hashes are flushed once they 
+				#		are old enough and the failed nodes are retried once their
+				#		backoff is over
+				wave = None
+				while wave is None:
+					try:
+						wave = [done.get(True, wait())]
+					except Queue.Empty:
+						store.commit()
+						if retries and retries[0][0] <= time.time():
+							wave = []
+
+				while True:
+					try:
+						wave.append(done.get_nowait())
+					except Queue.Empty:
+						break
+
+				for x, status in wave:
+					# the node is hashed, check its state
+					if status == 'hashed':
+						run(x)
+						continue
+
+					if status == 'missed':
+						enqueue(x)
+						continue
+
+					# the node is then hashed again as if its payload ran
+					if status == 'restored':
+						if DEBUG:
+							print 'Node ' + x.nid + \
+								': update: restored from cache'
+
+						del keys[id(x)]
+						x._elapsed = None
+						self._hash_cache.pop(x.nid, None)
+						status = 'ran'
+
+					if status in ('ran', 'failed'):
+						touched.add(id(x))
+
+					# the payload is done, let waiting nodes use the resources
+					# NOTE: the nodes of a chain which did not run are also done
+					if id(x) in running:
+						release_resources(x)
+
+					# keep the wall time to estimate the critical path later
+					# NOTE: nodes restored from the cache have no wall time
+					if status == 'ran' and x._elapsed is not None:
+						store.put_time(x.nid, x._elapsed)
+
+					# keep the outputs in the cache
+					if status == 'ran' and id(x) in keys:
+						copier.apply_async(_cache_put, (self.cache, 
+							keys.pop(id(x)), list(x.outputs)))
+
+					if status == 'failed':
+						# try again after the backoff
+						n = attempts.get(id(x), 1)
+						if n < x.attempts:
+							if DEBUG:
+								print 'Node ' + x.nid + ': update: retry'
+
+							attempts[id(x)] = n + 1
+							heapq.heappush(retries, (time.time() + 
+								x.backoff*2**(n - 1), next(count), x))
+							continue
+
+						if not keep_going:
+							if fail_fast:
+								cancel()
+							raise RuntimeError('Node ' + x.nid + 
+								': error executing payload' + ('' 
+								if x._error is None else '\n' + str(x._error)))
+
+						if DEBUG:
+							print 'Node ' + x.nid + ': update: failed'
+
+						# the descendants are not run, the nodes of a chain 
+						# after the failed one give back their resources
+						out = block(x)
+						for y in out:
+							if id(y) in running:
+								release_resources(y)
+						failures[x.nid] = [y.nid for y in out]
+						left -= 1 + len(out)
+						continue
+
+					# hash the node again in the thread pool
+					if status == 'ran' and hasher is not None:
+						hasher.apply_async(_prehash, (x,), 
+							callback=lambda y: done.put((y, 'ok')))
+						continue
+
+					# update hash table and mark node as updated
+					try:
+						x._update()
+					except Exception:
+						if not keep_going:
+							raise
+						unhashable(x)
+						continue
+					left -= 1
+
+					[check(y) for y in release(x)]
+
+				# the nodes retried wait for resources again
+				while retries and retries[0][0] <= time.time():
+					enqueue(heapq.heappop(retries)[2])
+
+				admit()
+				store.commit()
+
+		finally:
+			if hasher is not None:
+				hasher.close()
+				hasher.join()
+
+			# the outputs are stored in the cache before returning
+			if copier is not None:
+				copier.close()
+				copier.join()
+
+			# drop the records of the nodes left out of date, which the next 
+			# update would take as up to date otherwise, see changed
+			# NOTE: a node whose parent ran is out of date as well, its record
+			#		holds the previous hash of the parent
+			for x in itertools.chain(trv, cone):
+				if not x._update_done and (id(x) in touched or 
+					id(x) in blocked or any([id(y) in touched 
+					for y in x.parents])):
+					store.delete(x.nid)
+
+			# keep the hashes of the nodes which did update
+			store.flush()
+
+		return failures
+
+class Build(object):
+	"""
+	The Build is the handle of an update running in the background.
+
+	The scheduler of the update runs in its own thread, so the caller is free
+	to do other work, or to start updates in other sessions, while the payloads
+	run. wait() blocks until the update is done and raises the exception of 
+	the update if it failed. Once done, failures holds the value returned by 
+	the update.
+
+	Builds are started by Session.update_async, which takes the session for 
+	the update; the build gives it back once the update is done.
+	"""
+	def __init__(self, session, nodes, changed=None, keep_going=False, 
+		fail_fast=False):
+		super(Build, self).__init__()
+
+		# exception info of a failed update
+		self._exc_info = None
+
+		# failed nodes returned by the update
+		self.failures = None
+
+		self._thread = threading.Thread(target=self._run, 
+			args=(session, nodes, changed, keep_going, fail_fast))
+		self._thread.daemon = True
+		self._thread.start()
+
+	def _run(self, session, nodes, changed, keep_going, fail_fast):
+		'''Run the update, keeping the exception if it fails'''
+
+		try:
+			self.failures = session._update(nodes, changed, keep_going, 
+				fail_fast)
+		except Exception:
+			self._exc_info = sys.exc_info()
+		finally:
+			session._running.release()
+
+	def done(self):
+		'''Return true if the update is done'''
+
+		return not self._thread.is_alive()
+
+	def wait(self, timeout=None):
+		'''
+		Wait for the update to be done, at most timeout seconds if given. 
+		Return true if it is done, raise its exception if it failed.
+		'''
+
+		# NOTE: the thread is joined a second at a time, joining it without a
+		#		timeout cannot be interrupted, e.g., by Ctrl-C
+		end = None if timeout is None else time.time() + timeout
+		while self._thread.is_alive():
+			left = 1.0 if end is None else min(1.0, end - time.time())
+			if left <= 0:
+				return False
+			self._thread.join(left)
+
+		if self._exc_info is not None:
+			raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+
+		return True
+
+class Graph(object):
+	"""
+	The Graph is a registry of nodes.
+
+	Every node registers with a graph on construction and is given an integer 
+	index into it. The graph keeps the parents (reverse adjacency) and the 
+	children (forward adjacency) of each node as arrays of indices, so that the
+	children or the descendants of a node are found without rescanning the 
+	tree. The parents of a node must belong to the same graph.
+
+	The indices are kept in slices of two arrays, one for the parents and one
+	for the children, rather than in an array per node. A slice which grows is
+	moved to the end of its array, the children slices with room for twice as
+	many, so that adding an edge takes amortized constant time.
+
+	The graph also keeps a topological order of the nodes, i.e., the position
+	of each node comes after those of its parents. Edges added after the 
+	nodes are registered are checked for cycles against it, see add_edge.
+
+	For very large trees, the graph can be turned into a depmcsr.CSRGraph, 
+	which checks and propagates changes over all the nodes with NumPy.
+
+	A graph holds on to its nodes until it is dropped or cleared, see clear().
+	The nodes created without a graph register with default_graph, which lives
+	as long as the module, so long-lived processes, e.g., a file watcher 
+	creating nodes on each change, must use graphs of their own.
+	"""
+	def __init__(self):
+		super(Graph, self).__init__()
+
+		# registered nodes, the index of a node is its position in this list
+		self.nodes = list()
+
+		# parent indices of each node, in the slice of length _plen[i] starting
+		# at _pstart[i] of _pidx
+		self._pidx = array.array('i')
+		self._pstart = array.array('i')
+		self._plen = array.array('i')
+
+		# child indices of each node likewise, each slice with room for 
+		# _ccap[i] indices
+		self._cidx = array.array('i')
+		self._cstart = array.array('i')
+		self._clen = array.array('i')
+		self._ccap = array.array('i')
+
+		# position of each node in the topological order
+		self._ord = array.array('i')
+
+	def __len__(self):
+
+		return len(self.nodes)
+
+	def clear(self):
+		'''
+		Drop all the nodes, so that they can be freed. The nodes dropped are 
+		left without a graph and must not be used anymore.
+		'''
+
+		for x in self.nodes:
+			x._graph = None
+
+		self.__init__()
+
+	def add(self, node, parents=()):
+		'''Register a node and its parents, return the index of the node'''
+
+		for x in parents:
+			if x._graph is not self:
+				raise ValueError('Node ' + node.nid + ': parent ' + x.nid + 
+					' belongs to another graph')
+
+		idx = len(self.nodes)
+		self.nodes.append(node)
+
+		self._pstart.append(len(self._pidx))
+		self._plen.append(len(parents))
+		self._pidx.extend([x._idx for x in parents])
+
+		self._cstart.append(len(self._cidx))
+		self._clen.append(0)
+		self._ccap.append(0)
+
+		# forward adjacency
+		for x in parents:
+			self._add_child(x._idx, idx)
+
+		# the parents are registered already, so the node goes last
+		self._ord.append(idx)
+
+		return idx
+
+	def add_edge(self, parent, child):
+		'''
+		Add parent to the parents of child in the graph, raise ValueError if 
+		child is parent or one of its (grand-)parents.
+
+		The topological order is maintained with the algorithm of Pearce and 
+		Kelly. If parent comes before child already, nothing moves. Otherwise,
+		only the nodes positioned between child and parent are searched: the 
+		descendants of child and the ancestors of parent found there are given
+		the positions of the region again, ancestors first. An edge closing a
+		cycle is found by the same search, so each edge costs time 
+		proportional to the part of the order it affects rather than to the 
+		size of the graph.
+		'''
+
+		for x in [parent, child]:
+			if x._graph is not self:
+				raise ValueError('Node ' + x.nid + ' belongs to another graph')
+
+		x, y = parent._idx, child._idx
+		lb, ub = self._ord[y], self._ord[x]
+
+		if x == y:
+			raise ValueError('Node ' + child.nid + ' cannot be its own parent')
+
+		if lb < ub:
+			# descendants of child up to parent, reaching parent is a cycle
+			fwd = []
+			seen = set([y])
+			stack = [y]
+			while stack:
+				i = stack.pop()
+				fwd.append(i)
+				for j in self._children_of(i):
+					if j == x:
+						raise ValueError('Node ' + child.nid + ': parent ' + 
+							parent.nid + ' would close a cycle')
+					if j not in seen and self._ord[j] < ub:
+						seen.add(j)
+						stack.append(j)
+
+			# ancestors of parent down to child
+			bwd = []
+			seen = set([x])
+			stack = [x]
+			while stack:
+				i = stack.pop()
+				bwd.append(i)
+				for j in self._parents_of(i):
+					if j not in seen and self._ord[j] > lb:
+						seen.add(j)
+						stack.append(j)
+
+			# reuse the positions of the region, ancestors first
+			fwd.sort(key=self._ord.__getitem__)
+			bwd.sort(key=self._ord.__getitem__)
+			slots = sorted([self._ord[i] for i in bwd + fwd])
+			for i, p in zip(bwd + fwd, slots):
+				self._ord[i] = p
+
+		# the slice of parents moves to the end of the array, unless it is 
+		# there already
+		start, n = self._pstart[y], self._plen[y]
+		if start + n != len(self._pidx):
+			self._pstart[y] = len(self._pidx)
+			self._pidx.extend(self._pidx[start:start + n])
+		self._pidx.append(x)
+		self._plen[y] = n + 1
+
+		self._add_child(x, y)
+
+	def _add_child(self, i, j):
+		'''Append index j to the children of node i'''
+
+		start, n = self._cstart[i], self._clen[i]
+		if n == self._ccap[i]:
+			# move the slice to the end of the array, with room to grow
+			cap = max(1, 2*n)
+			self._cstart[i] = len(self._cidx)
+			self._cidx.extend(self._cidx[start:start + n])
+			self._cidx.extend([-1] * (cap - n))
+			self._ccap[i] = cap
+			start = self._cstart[i]
+
+		self._cidx[start + n] = j
+		self._clen[i] = n + 1
+
+	def _parents_of(self, i):
+		'''Return the array of parent indices of node i'''
+
+		start = self._pstart[i]
+		return self._pidx[start:start + self._plen[i]]
+
+	def _children_of(self, i):
+		'''Return the array of child indices of node i'''
+
+		start = self._cstart[i]
+		return self._cidx[start:start + self._clen[i]]
+
+	def order(self):
+		'''Return the list of nodes in topological order, parents first'''
+
+		return [self.nodes[i] for i in 
+			sorted(xrange(len(self.nodes)), key=self._ord.__getitem__)]
+
+	def parents(self, node):
+		'''Return the list of parents of node'''
+
+		nodes = self.nodes
+		return [nodes[i] for i in self._parents_of(node._idx)]
+
+	def children(self, node):
+		'''Return the list of children of node'''
+
+		nodes = self.nodes
+		return [nodes[i] for i in self._children_of(node._idx)]
+
+	def descendants(self, nodes):
+		'''
+		Return the list of all (grand-)children of a node or list of nodes.
+		The search is breadth-first over the children arrays, so it runs in 
+		time proportional to the size of the output.
+		'''
+
+		# turn into list if not
+		if not isinstance(nodes,list):
+			nodes = [nodes]
+
+		seen = set([x._idx for x in nodes])
+		q = [x._idx for x in nodes]
+		out = []
+		while q:
+			aux = []
+			for i in q:
+				for j in self._children_of(i):
+					if j not in seen:
+						seen.add(j)
+						aux.append(j)
+			out.extend(aux)
+			q = aux
+
+		return [self.nodes[i] for i in out]
+
+# default graph to which nodes register
+default_graph = Graph()
+
 class Node(object):
 	"""
 	The Node is the most basic unit of the tree. 
 	Subclasses are used to create specialized types of node, e.g., a File or an 
 	Action.
 
-	The Node requires a pool object to which a executing payload is delivered.
-	parents is a list of parent Nodes. nid is the node id, one is automatically
-	assigned if missing. Payload is a module-level function to be sent to the 
-	execution queue before the node is declared as up-to-date.
+	The Node requires a pool object to which a executing payload is delivered,
+	either an executor from depmpp or a pool from multiprocessing. If pool is 
+	None, the executor attribute of the node type is used, so that each type 
+	of node can run on its own backend. parents is a list of parent Nodes. 
+	nid is the node id, one is automatically assigned if missing. Payload is 
+	a module-level function to be sent to the execution queue before the node
+	is declared as up-to-date. The node registers with graph, default_graph 
+	if missing. resources is a dictionary with the amount of each named 
+	resource used by the payload, one 'cpu' if missing; see Session.
+
+	If timeout is given, a payload running for more than timeout seconds 
+	fails, and its worker is killed if the executor allows it; see depmpp. A 
+	failed payload is run again up to attempts times in total within the same
+	update, waiting backoff seconds before the second attempt and twice as 
+	long before each of the next ones.
+
+	outputs is a list of the paths of the files written by the payload, which
+	are kept in the cache of the session, if any; see Session and action().
+
+	The attributes of the node are kept in slots, the automatic node ids as 
+	integers and the flags packed in an integer, and the parents are kept by 
+	the graph, so that millions of nodes fit in memory. Subclasses which do 
+	not declare __slots__ get a __dict__ as usual.
 	"""
-	def __init__(self, pool, parents=[], nid=None, payload=payload):
+
+	__slots__ = ['_nid', '_flags', '_pool', '_payload', 'resources', 'timeout',
+		'attempts', 'backoff', 'outputs', '_response', '_elapsed', '_error', 
+		'_queue', '_session', '_graph', '_idx']
+
+	# default executor of the node type, see depmpp
+	executor = None
+
+	def __init__(self, pool, parents=[], nid=None, payload=payload, graph=None,
+		resources=None, timeout=None, attempts=1, backoff=1.0, outputs=None):
 		super(Node, self).__init__()
 
 		# assign unique id
+		# NOTE: automatic ids are kept as integers, see the nid property
 		if nid is None:
 			global gid
-			self.nid = str(gid)
+			self._nid = gid
 			gid = gid + 1
+		else:
+			self._nid = str(nid)
 
 		# add list of parents
 		#  set to list if not none
 		if not isinstance(parents,list):
 			parents = list([parents])
-		self.parents = parents
 
-		# variables to keep track of events
-		self._payload_delivered = False
-		self._update_done = False
+		# variables to keep track of events, see the flag properties
+		self._flags = 0
 
 		# get the pool to submit jobs from the main program
-		self._pool = pool
+		if pool is None:
+			pool = self.executor
+		self._pool = depmpp.executor(pool)
 
 		# module level function to be executed in the processing pool
 		# NOTE: This function is passed to the processing pool. Therefore, the 
@@ -219,26 +1429,112 @@ class Node(object):
 		#		module-level function.
 		self._payload = payload
 
+		# resources used by the payload
+		# NOTE: the defaults are shared by the nodes, they are not modified
+		if resources is None:
+			resources = _default_resources
+		self.resources = resources
+
+		# timeout of the payload and retry policy
+		self.timeout = timeout
+		self.attempts = attempts
+		self.backoff = backoff
+
+		# files written by the payload
+		if outputs is None:
+			outputs = ()
+		self.outputs = outputs
+
 		# object storing the response object of the assynchronous call
 		self._response = None
 
+		# wall time of the last execution of the payload
+		self._elapsed = None
+
+		# error raised by the executor when running the payload
+		self._error = None
+
+		# scheduler queue to put the node in when it is done
+		self._queue = None
+
+		# session updating the node
+		self._session = None
+
+		# register with the graph, which keeps the parents and the children
+		if graph is None:
+			graph = default_graph
+		self._graph = graph
+		self._idx = graph.add(self, parents)
+
 		## NOTE: at this point, the node's parents are set at instance creation
-		#		 time. If the list of parents is not changed afterwards, cyclic
-		#		 dependencies are automatically avoided.
-		#		 If it becomes necessary to add new parents to a node, then 
-		# 		 it also becomes necessary to check for cyclic dependencies at 
-		# 		 the point where additional parents are included.
-		# # this is used to check for closed loops in the tree
-		# # could not think of a simpler method
-		# self._all_parents = list()
-		# [self._all_parents.extend(x._all_parents) for x in parents]
-		# if self in self._all_parents:
-		# 	raise ValueError('Cyclic dependency detected in node ' + self.nid)
+		#		 time, so they cannot close a cycle. Parents added afterwards 
+		#		 go through add_parent, where the graph checks for cycles.
 
 	def __str__(self):
 
 		return self.nid
 
+	@property
+	def nid(self):
+		'''The node id, a string'''
+
+		nid = self._nid
+		return nid if nid.__class__ is str else str(nid)
+
+	@property
+	def parents(self):
+		'''The list of parents, kept by the graph'''
+
+		# NOTE: a node sent to a worker is left without its graph
+		if self._graph is None:
+			return []
+
+		return self._graph.parents(self)
+
+	@property
+	def _update_done(self):
+		'''Flag of the node marked as up to date'''
+
+		return bool(self._flags & _UPDATE_DONE)
+
+	@_update_done.setter
+	def _update_done(self, value):
+
+		if value:
+			self._flags |= _UPDATE_DONE
+		else:
+			self._flags &= ~_UPDATE_DONE
+
+	@property
+	def _payload_delivered(self):
+		'''Flag of the payload sent to the pool'''
+
+		return bool(self._flags & _PAYLOAD_DELIVERED)
+
+	@_payload_delivered.setter
+	def _payload_delivered(self, value):
+
+		if value:
+			self._flags |= _PAYLOAD_DELIVERED
+		else:
+			self._flags &= ~_PAYLOAD_DELIVERED
+
+	def add_parent(self, node):
+		'''
+		Add node to the parents of this node. A ValueError is raised if this 
+		node is node or one of its (grand-)parents, as the dependency would 
+		close a cycle. This node and its descendants are checked again by the 
+		next update.
+		'''
+
+		self._graph.add_edge(node, self)
+
+		# NOTE: the descendants of a node not up to date are not either
+		if self._update_done:
+			self._update_done = False
+			for x in self._graph.descendants(self):
+				x._update_done = False
+
 	def __key(self):
 		'''
 		Return a string which can be used as a unique represntation of this 
@@ -265,11 +1561,83 @@ class Node(object):
 
 		return hashlib.md5(str(self.__key())).hexdigest()
 
+	def action(self):
+		'''
+		Return a string identifying the action of the node, which keys the 
+		outputs of the node in the cache along with the hashes of its parents.
+
+		By default, this is made of the payload, the node id and the outputs. 
+		Subclasses whose payload depends on other settings should add them.
+		'''
+
+		return '%s.%s:%s:%s' % (self._payload.__module__, 
+			self._payload.__name__, self.nid, ','.join(self.outputs))
+
+	def __getstate__(self):
+		'''
+		Return the state to pickle when the node is sent to a worker process, 
+		see Session. The parents, the graph and the scheduler are left behind.
+		'''
+
+		state = dict()
+		for cls in type(self).__mro__:
+			for k in getattr(cls, '__slots__', ()):
+				if hasattr(self, k):
+					state[k] = getattr(self, k)
+		state.update(getattr(self, '__dict__', {}))
+
+		for k in ['_pool', '_response', '_queue', '_session', '_graph']:
+			state[k] = None
+
+		return state
+
+	def __setstate__(self, state):
+		'''Restore the state pickled by __getstate__'''
+
+		for k, v in state.iteritems():
+			setattr(self, k, v)
+
 	def __eq__(x, y):
 		'''Define node equality'''
 		
 		return x.__key() == y.__key()
 
+	def _hash(self):
+		'''
+		Return the hash of the node, computed at most once per update.
+		The cached value is dropped when the payload of the node completes.
+		'''
+
+		session = self._session
+		while True:
+			try:
+				return session._hash_cache[self.nid]
+			except KeyError:
+				pass
+
+			# only one thread computes the hash, the others wait for it
+			with session._hash_lock:
+				if self.nid in session._hash_cache:
+					return session._hash_cache[self.nid]
+
+				event = session._hash_events.get(self.nid)
+				if event is None:
+					event = session._hash_events[self.nid] = threading.Event()
+					break
+
+			# NOTE: if the hash failed, the cache is still empty and the hash
+			#		is computed again
+			event.wait()
+
+		try:
+			hsh = session._hash_cache[self.nid] = self.hash()
+		finally:
+			with session._hash_lock:
+				del session._hash_events[self.nid]
+			event.set()
+
+		return hsh
+
 	def is_updated(self):
 		'''Return true if marked as up-to-date, otherwise trigger an update'''
 
@@ -278,72 +1646,86 @@ class Node(object):
 		else:
 			return False
 
-	def _trigger_update(self):
+	def _trigger_update(self, queue):
 		'''
-		After all parents are up to date, the node sends its payload to the pool
+		Called by the scheduler once all parents are up to date.
+		If the node needs no recomputation it is put in queue straight away 
+		and False is returned. Otherwise True is returned, the scheduler then
+		delivers the payload once resources are available.
 		'''
 
-		# all parents must be uptodate
-		if not all([x._update_done for x in self.parents]):
-			[x._trigger_update() for x in self.parents if not x._update_done]
-
-			if DEBUG:
-				print 'Node ' + self.nid + ': update: wait parents'
+		# the queue is used in the pool callback
+		self._queue = queue
 
 		# check state, if it is ok then no need to recompute node
-		elif self._check_state() == 'ok':
+		if self._check_state() == 'ok':
 
 			if DEBUG:
 				print 'Node ' + self.nid + ': update: no changes'
 
-			# mark node as updated
-			self._update()			
-		
+			queue.put((self, 'ok'))
+			return False
+
 		# otherwise need to recompute the node
-		# if payload was not delivered yet for processing, do it
-		elif not self._payload_delivered:
+		return True
 
-			if DEBUG:
-				print 'Node ' + self.nid + ': update: submit to pool'
+	def _deliver(self, queue):
+		'''
+		Send the payload to the pool, the node is put in queue by the callback
+		'''
 
-			# deliver payload to the processing pool
-			self._response = self._pool.apply_async(self._payload, (self.nid,), 
-			 	callback=self._update_callback)
-			# self.pool.apply(payload, (self.nid,))
-			# self.payload_callback()
+		if DEBUG:
+			print 'Node ' + self.nid + ': update: submit to pool'
 
-			# mark payload delivered
-			self._payload_delivered = True
+		# the queue is used in the pool callback
+		self._queue = queue
 
-		# if payload has failed raise an exception
-		elif self._response.ready() and not self._response.successful():
+		# deliver payload to the processing pool
+		# NOTE: the payload is wrapped in _execute so that the callback is
+		#		called even if the payload raises an exception
+		self._response = self._pool.apply_async(_execute, 
+			(self._payload, self.nid), callback=self._update_callback, 
+			error_callback=self._error_callback, timeout=self.timeout)
 
-			raise RuntimeError('Failed to execute payload')
+		# mark payload delivered
+		self._payload_delivered = True
 
 		# NOTE: when payload is done executing, the node callback function is 
-		#		triggered which changes the status of the node. At this point 
-		# 		this function will return immediately at the first if statement.
+		#		triggered in the pool result thread, which hands the node back 
+		#		to the scheduler.
 
-		# slow things down in debug mode
-		if DEBUG:
-			time.sleep(1.0)
-
-		return
-
-	def _update_callback(self, success):
+	def _update_callback(self, result):
 		'''
-		Callback function to set the update flag after the payload has been
+		Callback function to notify the scheduler after the payload has been
 		executed
 		'''
 
+		success, self._elapsed, error = result
+		if error is not None:
+			self._error = RuntimeError(error)
+
 		if DEBUG:
 			print 'Node ' + self.nid + ': callback'
 
-		if success:
-			self._update()
+		# the payload may have changed the node, hash it again
+		self._session._hash_cache.pop(self.nid, None)
 
+		if success:
+			self._queue.put((self, 'ran'))
 		else:
-			raise RuntimeError('Node ' + self.nid + ': error executing payload')
+			self._queue.put((self, 'failed'))
+
+	def _error_callback(self, error):
+		'''
+		Callback function to notify the scheduler when the executor failed to 
+		run the payload
+		'''
+
+		if DEBUG:
+			print 'Node ' + self.nid + ': error callback'
+
+		self._error = error
+		self._queue.put((self, 'failed'))
 
 	def _update(self):
 		'''Update my hash in the hash table and set the update flag'''
@@ -353,10 +1735,11 @@ class Node(object):
 			raise RuntimeError('All parents must be updated')
 
 		# gather parents hashes
-		list_parents_and_hashes = [(x.nid, x.hash()) for x in self.parents]
+		list_parents_and_hashes = [(x.nid, x._hash()) for x in self.parents]
 
 		# update hash_table
-		_write_hashes(self.nid, self.hash(), list_parents_and_hashes)
+		self._session.store.put(self.nid, self._hash(), 
+			list_parents_and_hashes)
 
 		# mark node as updated
 		self._update_done = True
@@ -369,69 +1752,80 @@ class Node(object):
 		An exception is raised if any parent is not marked as updated.
 		'''
 
-		# control variable
-		return_flag = False
-
 		# check that all parents are ready
 		if not all([x._update_done for x in self.parents]):
 			raise RuntimeError('All parents must be updated')
 
 		# check that node exists
-		if self.nid not in hash_table:
+		if self.nid not in self._session.store:
 			if DEBUG:
 				print 'Node ' + self.nid + ': _check_state: new'
 			return 'new'
 
-		# retrieve data from hash_table
-		my_hash, list_parents_prev = _read_hashes(self.nid)
+		# compare with the data from hash_table
+		return _compare(self.nid, self._session.store.get(self.nid), 
+			self._hash(), [(x.nid, x._hash()) for x in self.parents])
 
-		# check that node did not change:
-		if self.hash() != my_hash:
-			if DEBUG:
-				print 'Node ' + self.nid + ': _check_state: changed'
-			return 'changed'
 
-		# check that parents are the same:
-		list_parents_now = [(x.nid, x.hash()) for x in self.parents]
+class FileNode(Node):
+	"""
+	The FileNode is a node whose hash is the MD5 of the contents of a file.
 
-		# check that no previous dependencies are missing
-		for item in [x[0] for x in list_parents_prev]:
-			if item not in [x[0] for x in list_parents_now]:
-				# old dependencies gone
-				if DEBUG:
-					print 'Node ' + self.nid + ': _check_state: node', item, 'no longer a dependency'
-				return_flag = True
+	The stat signature of the file (size, modification time and inode) is kept
+	in the hash table along with the hash of its contents. The file is only 
+	read again when the signature changes, so checking an unchanged file costs 
+	a single stat call. path is the path to the file, which is also the node id
+	if nid is missing. The other arguments are those of Node.
+	"""
 
-		# check new dependencies
-		for item in [x[0] for x in list_parents_now]:
-			if item not in [x[0] for x in list_parents_prev]:
-				# new dependencies
-				if DEBUG:
-					print 'Node ' + self.nid + ': _check_state: node', item, 'is a new dependency'
-				return_flag = True
+	__slots__ = ['path']
 
-		if return_flag:
-			return 'parents_number'
+	def __init__(self, pool, path, parents=[], nid=None, **kwargs):
 
-		# check the order of the dependencies
-		for i in range(len(list_parents_now)):
-			if list_parents_now[i][0] != list_parents_prev[i][0]:
-				if DEBUG:
-					print 'Node ' + self.nid + ': _check_state: order of dependencies changed'
-				return 'parents_order'
-
-		# check the hashes
-		# NOTE: up to here we already checked the number and order of the 
-		# 		elements in the list
-		for i in range(len(list_parents_now)):
-			if list_parents_now[i] != list_parents_prev[i]:
-				if DEBUG:
-					print 'Node ' + self.nid + ': _check_state: '. list_parents_now[i][0], ' has changed'
-				return_flag = True
-		
-		if return_flag:		
-			return 'parents_changed'
+		# path to the file
+		self.path = path
 
-		# if none of the above apply, then all is good
-		return 'ok'
+		if nid is None:
+			nid = path
+
+		super(FileNode, self).__init__(pool, parents, nid, **kwargs)
+
+	def hash(self):
+		'''
+		Hashing function for file nodes
+
+		Returns the MD5 of the file contents, or an empty string if the file 
+		does not exist. The contents are only read if the stat signature of the 
+		file differs from the one in the hash table.
+		'''
 
+		try:
+			st = os.stat(self.path)
+		except OSError:
+			return ''
+
+		sig = '%d:%d:%d' % (st.st_size, int(st.st_mtime*1e9), st.st_ino)
+
+		# fast path, the file did not change since it was last hashed
+		# NOTE: the signatures are kept in the hash table of the session 
+		#		updating the node, there is none outside of an update
+		store = None
+		if self._session is not None:
+			store = self._session.store
+			prev = store.get_stat(self.nid)
+			if prev is not None and prev[0] == sig:
+				return prev[1]
+
+		md5 = hashlib.md5()
+		with open(self.path, 'rb') as f:
+			for chunk in iter(lambda: f.read(1 << 20), ''):
+				md5.update(chunk)
+		hsh = md5.hexdigest()
+
+		# NOTE: a file modified right now could be modified again without 
+		#		changing its modification time, so its signature is only 
+		#		trusted once it is older than the timestamp resolution
+		if store is not None and time.time() - st.st_mtime > 1.0:
+			store.put_stat(self.nid, sig, hsh)
+
+		return hsh
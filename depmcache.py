@@ -0,0 +1,616 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Cache of the outputs of the nodes of the dependency manager.
+
+The outputs of a node are the files written by its payload. Once the payload
+ran, the outputs are copied into the cache under a key made of the action of
+the node and the hashes of its parents, in order. When a later update needs
+to run the payload with the same action and parent hashes, e.g., after
+switching branches or reverting an input, the outputs are restored from the
+cache instead.
+
+The cache is a directory with an entry per key, holding the outputs of the
+node, along with a SQLite index of the size and last use of each entry. The
+least recently used entries are evicted once the cache grows over its size.
+
+A cache can be shared among machines through an HTTP server keeping the 
+entries, see RemoteCache. The protocol is plain GET and PUT of,
+	- /<key>/<i>	: output i of entry key
+	- /<key>		: number of outputs of entry key, put once they are all 
+					  uploaded
+A small server is bundled, which is started by
+	python depmcache.py <path> [[host:]port]
+It listens on localhost unless another host is given. The server does not 
+authenticate its clients, so anyone reaching it can store entries, i.e., 
+outputs restored by the builds using it: only listen on a trusted network.
+'''
+
+import os
+import sys
+import errno
+import shutil
+import sqlite3
+import hashlib
+import threading
+import time
+import re
+import socket
+import tempfile
+import httplib
+import urlparse
+import BaseHTTPServer
+import SocketServer
+import multiprocessing.pool
+
+## Metadata
+__author__='Pedro Inácio'
+
+## Module functions
+def key(action, parents):
+	'''
+	Return the cache key of a node, given its action and the list of (nid,
+	hash) of its parents
+	'''
+
+	md5 = hashlib.md5(action)
+	for nid, hsh in parents:
+		md5.update('\0' + nid + '\0' + hsh)
+
+	return md5.hexdigest()
+
+def _restore(src, dst, link):
+	'''Restore file src at dst, as a hard link if link is true'''
+
+	parent = os.path.dirname(dst)
+	if parent and not os.path.isdir(parent):
+		try:
+			os.makedirs(parent)
+		except OSError as e:
+			if e.errno != errno.EEXIST:
+				raise
+
+	if os.path.lexists(dst):
+		os.remove(dst)
+
+	if link:
+		try:
+			os.link(src, dst)
+			return
+		except OSError:
+			# NOTE: hard links do not cross file systems
+			pass
+
+	shutil.copyfile(src, dst)
+
+def serve(path, host='localhost', port=0):
+	'''
+	Return an HTTP server keeping the entries of a remote cache in the 
+	directory path, listening at host and port, any free port if 0. The server
+	runs in a thread until its shutdown method is called; its address is in
+	server_address.
+
+	NOTE: processes forked while the server runs, e.g., the workers of a 
+	processing pool, inherit its socket, which then accepts connections after
+	the server is shut down. Create the processing pools first.
+	'''
+
+	if not os.path.isdir(path):
+		os.makedirs(path)
+
+	server = CacheServer((host, port), CacheHandler)
+	server.path = path
+
+	t = threading.Thread(target=server.serve_forever)
+	t.daemon = True
+	t.start()
+
+	return server
+
+## Module classes
+class Cache(object):
+	"""
+	Local content-addressed cache of node outputs in the directory path, of at
+	most max_size bytes.
+
+	Outputs are copied into the cache. They are restored as copies, or as hard
+	links if link is true, which is faster but shares the file with the cache:
+	a payload writing to its outputs in place would then corrupt the cache.
+
+	The index is opened on first use, so a cache can be created before the
+	processing pools. The hits, misses and bytes restored are counted, see
+	stats().
+	"""
+	def __init__(self, path, max_size=1 << 30, link=False):
+		super(Cache, self).__init__()
+
+		self.path = path
+		self.max_size = max_size
+		self.link = link
+
+		# counters of the lookups
+		self.hits = 0
+		self.misses = 0
+		self.bytes_saved = 0
+
+		# index of the entries, see the db property
+		# NOTE: the connection is shared by the threads, using the lock
+		self._db = None
+		self._lock = threading.Lock()
+
+	@property
+	def db(self):
+		'''The index of the entries, opened on first use'''
+
+		if self._db is None:
+			if not os.path.isdir(self.path):
+				os.makedirs(self.path)
+
+			self._db = sqlite3.connect(os.path.join(self.path, 'index.sqlite'),
+				check_same_thread=False)
+			self._db.text_factory = str
+			self._db.execute('PRAGMA journal_mode=WAL')
+			self._db.executescript('''
+				CREATE TABLE IF NOT EXISTS entries (
+					key TEXT PRIMARY KEY,
+					size INTEGER NOT NULL,
+					used REAL NOT NULL);
+				CREATE INDEX IF NOT EXISTS entries_used ON entries (used);
+				''')
+
+		return self._db
+
+	def _entry(self, key):
+		'''Return the directory of the entry key'''
+
+		return os.path.join(self.path, key[:2], key)
+
+	def __contains__(self, key):
+
+		with self._lock:
+			return self.db.execute('SELECT 1 FROM entries WHERE key = ?',
+				(key,)).fetchone() is not None
+
+	def get(self, key, paths):
+		'''
+		Restore the outputs of entry key at paths, in order. Return true on a
+		hit, false if there is no such entry.
+		'''
+
+		entry = self._entry(key)
+		with self._lock:
+			row = self.db.execute('SELECT size FROM entries WHERE key = ?',
+				(key,)).fetchone()
+
+			if row is None:
+				self.misses += 1
+				return False
+
+			# an entry whose files are lost is dropped, so that it is stored 
+			# again by the next put
+			if not all([os.path.exists(os.path.join(entry, str(i))) 
+				for i in range(len(paths))]):
+				self.db.execute('DELETE FROM entries WHERE key = ?', (key,))
+				self.db.commit()
+				shutil.rmtree(entry, True)
+				self.misses += 1
+				return False
+
+			self.db.execute('UPDATE entries SET used = ? WHERE key = ?',
+				(time.time(), key))
+			self.db.commit()
+
+		for i, path in enumerate(paths):
+			_restore(os.path.join(entry, str(i)), path, self.link)
+
+		with self._lock:
+			self.hits += 1
+			self.bytes_saved += row[0]
+
+		return True
+
+	def put(self, key, paths):
+		'''
+		Copy the files at paths into entry key, unless it exists, and evict the
+		least recently used entries if the cache is full. Return false if an
+		output is missing, in which case nothing is stored.
+		'''
+
+		if key in self:
+			return True
+
+		if not all([os.path.isfile(x) for x in paths]):
+			return False
+
+		# NOTE: the entry is written aside and renamed into place, so that a
+		#		concurrent reader never sees it half written
+		entry = self._entry(key)
+		tmp = entry + '.%d.%d' % (os.getpid(), threading.current_thread().ident)
+		if not os.path.isdir(os.path.dirname(entry)):
+			try:
+				os.makedirs(os.path.dirname(entry))
+			except OSError as e:
+				if e.errno != errno.EEXIST:
+					raise
+
+		os.mkdir(tmp)
+		size = 0
+		for i, path in enumerate(paths):
+			shutil.copyfile(path, os.path.join(tmp, str(i)))
+			size += os.path.getsize(path)
+
+		try:
+			os.rename(tmp, entry)
+		except OSError:
+			# another process stored the entry meanwhile
+			shutil.rmtree(tmp, True)
+
+		with self._lock:
+			self.db.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?)',
+				(key, size, time.time()))
+			self.db.commit()
+
+		self.evict()
+
+		return True
+
+	def evict(self, max_size=None):
+		'''
+		Remove the least recently used entries until the cache holds at most
+		max_size bytes, self.max_size if None
+		'''
+
+		if max_size is None:
+			max_size = self.max_size
+
+		with self._lock:
+			total = self.db.execute('SELECT TOTAL(size) FROM entries'
+				).fetchone()[0]
+			if total <= max_size:
+				return
+
+			gone = []
+			for key, size in self.db.execute('SELECT key, size FROM entries '
+				'ORDER BY used').fetchall():
+				if total <= max_size:
+					break
+				gone.append(key)
+				total -= size
+
+			self.db.executemany('DELETE FROM entries WHERE key = ?',
+				[(x,) for x in gone])
+			self.db.commit()
+
+		for x in gone:
+			shutil.rmtree(self._entry(x), True)
+
+	def stats(self):
+		'''
+		Return a dictionary with the number of hits and misses, the hit rate,
+		the bytes restored from the cache and the number and size of entries
+		'''
+
+		with self._lock:
+			entries, size = self.db.execute('SELECT COUNT(*), TOTAL(size) '
+				'FROM entries').fetchone()
+
+		lookups = self.hits + self.misses
+		return {'hits': self.hits, 'misses': self.misses,
+			'hit_rate': float(self.hits)/lookups if lookups else 0.0,
+			'bytes_saved': self.bytes_saved, 'entries': entries,
+			'size': int(size)}
+
+	def report(self):
+		'''Return the stats as a line of text'''
+
+		s = self.stats()
+		return 'Cache %s: %d hits, %d misses (%.1f%%), %d bytes saved, ' \
+			'%d entries of %d bytes' % (self.path, s['hits'], s['misses'],
+			100*s['hit_rate'], s['bytes_saved'], s['entries'], s['size'])
+
+	def close(self):
+		'''Close the index, it is opened again if needed'''
+
+		with self._lock:
+			if self._db is not None:
+				self._db.close()
+				self._db = None
+
+class RemoteCache(object):
+	"""
+	Cache of node outputs kept by an HTTP server at url, e.g., 
+	'http://localhost:8000', in front of which the local Cache local is used.
+
+	A lookup missing the local cache downloads the outputs from the server, 
+	in parallel, and keeps them in the local cache. The outputs put in the 
+	cache are kept in the local cache and uploaded in the background; 
+	close() waits for the uploads. The downloads and the uploads each use up
+	to jobs threads of their own, so that a lookup does not wait for the 
+	uploads queued. Requests fail after timeout seconds. A server which fails
+	or cannot be reached counts as a miss, the outputs are then produced by 
+	the payloads.
+	"""
+	def __init__(self, url, local, jobs=4, timeout=10.0):
+		super(RemoteCache, self).__init__()
+
+		url = urlparse.urlparse(url)
+		self.host = url.hostname
+		self.port = url.port or 80
+		self.prefix = url.path.rstrip('/')
+		self.local = local
+		self.jobs = jobs
+		self.timeout = timeout
+
+		# counters of the lookups and transfers
+		self.hits = 0
+		self.misses = 0
+		self.bytes_downloaded = 0
+		self.bytes_uploaded = 0
+		self._lock = threading.Lock()
+
+		# threads downloading and uploading the outputs
+		self._downloads = multiprocessing.pool.ThreadPool(jobs)
+		self._uploads = multiprocessing.pool.ThreadPool(jobs)
+
+	def _request(self, method, path, body=None, out=None):
+		'''
+		Send a request for path with body, return the status and the response
+		body, or its size if it is written to the file out
+		'''
+
+		conn = httplib.HTTPConnection(self.host, self.port, 
+			timeout=self.timeout)
+		try:
+			conn.request(method, self.prefix + path, body)
+			response = conn.getresponse()
+			if response.status != 200 or out is None:
+				return response.status, response.read()
+
+			size = 0
+			for chunk in iter(lambda: response.read(1 << 20), ''):
+				out.write(chunk)
+				size += len(chunk)
+			return response.status, size
+		finally:
+			conn.close()
+
+	def _download(self, key, i, path):
+		'''Download output i of entry key to path, return its size'''
+
+		with open(path, 'wb') as f:
+			status, size = self._request('GET', '/%s/%d' % (key, i), out=f)
+		if status != 200:
+			raise IOError('Cache entry ' + key + ': output ' + str(i) + 
+				' is missing')
+
+		return size
+
+	def _upload(self, key):
+		'''Upload entry key from the local cache, unless the server has it'''
+
+		try:
+			if self._request('HEAD', '/' + key)[0] == 200:
+				return
+
+			entry = self.local._entry(key)
+			n = len(os.listdir(entry))
+			size = 0
+			for i in range(n):
+				with open(os.path.join(entry, str(i)), 'rb') as f:
+					# NOTE: httplib sends a file body in blocks
+					status = self._request('PUT', '/%s/%d' % (key, i), f)[0]
+				if status != 200:
+					return
+				size += os.path.getsize(os.path.join(entry, str(i)))
+
+			if self._request('PUT', '/' + key, str(n))[0] == 200:
+				with self._lock:
+					self.bytes_uploaded += size
+
+		except (socket.error, httplib.HTTPException, EnvironmentError):
+			# NOTE: the entry is uploaded again the next time it is produced, 
+			#		or it was evicted from the local cache meanwhile
+			pass
+
+	def get(self, key, paths):
+		'''
+		Restore the outputs of entry key at paths, from the local cache or from
+		the server. Return true on a hit.
+		'''
+
+		if self.local.get(key, paths):
+			return True
+
+		# the downloads are kept in the directory of the local cache, which is
+		# created along with its index
+		self.local.db
+		tmp = tempfile.mkdtemp(dir=self.local.path)
+		try:
+			status, body = self._request('GET', '/' + key)
+			if status != 200 or int(body) != len(paths):
+				with self._lock:
+					self.misses += 1
+				return False
+
+			files = [os.path.join(tmp, str(i)) for i in range(len(paths))]
+			fetch = lambda i: self._download(key, i, files[i])
+			sizes = self._downloads.map(fetch, range(len(paths)))
+
+			self.local.put(key, files)
+			for src, dst in zip(files, paths):
+				_restore(src, dst, False)
+
+		except (socket.error, httplib.HTTPException, EnvironmentError, 
+			ValueError):
+			with self._lock:
+				self.misses += 1
+			return False
+
+		finally:
+			shutil.rmtree(tmp, True)
+
+		with self._lock:
+			self.hits += 1
+			self.bytes_downloaded += sum(sizes)
+
+		return True
+
+	def put(self, key, paths):
+		'''
+		Keep the files at paths in entry key of the local cache and upload them
+		in the background. Return false if an output is missing.
+		'''
+
+		if not self.local.put(key, paths):
+			return False
+
+		self._uploads.apply_async(self._upload, (key,))
+
+		return True
+
+	def stats(self):
+		'''
+		Return the stats of the local cache, see Cache.stats, where the hits 
+		and misses count both caches, along with the hits and misses of the 
+		server and the bytes downloaded and uploaded
+		'''
+
+		out = self.local.stats()
+		with self._lock:
+			out['local_hits'] = out['hits']
+			out['remote_hits'] = self.hits
+			out['hits'] += self.hits
+			out['misses'] = self.misses
+			out['bytes_downloaded'] = self.bytes_downloaded
+			out['bytes_uploaded'] = self.bytes_uploaded
+
+		lookups = out['hits'] + out['misses']
+		out['hit_rate'] = float(out['hits'])/lookups if lookups else 0.0
+		out['bytes_saved'] += self.bytes_downloaded
+
+		return out
+
+	def report(self):
+		'''Return the stats as a line of text'''
+
+		s = self.stats()
+		return 'Cache %s:%d: %d hits (%d remote), %d misses (%.1f%%), ' \
+			'%d bytes saved, %d bytes downloaded, %d bytes uploaded' % (
+			self.host, self.port, s['hits'], s['remote_hits'], s['misses'], 
+			100*s['hit_rate'], s['bytes_saved'], s['bytes_downloaded'], 
+			s['bytes_uploaded'])
+
+	def close(self):
+		'''Wait for the uploads and close the local cache'''
+
+		self._uploads.close()
+		self._uploads.join()
+		self._uploads = multiprocessing.pool.ThreadPool(self.jobs)
+		self.local.close()
+
+class CacheServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+	"""
+	HTTP server of a remote cache, see serve. Each request is handled in its 
+	own thread.
+	"""
+	daemon_threads = True
+	allow_reuse_address = True
+
+class CacheHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+	"""
+	Handler of the requests to a CacheServer. The entries are kept in the 
+	directory of the server, the outputs are written aside and renamed into 
+	place.
+	"""
+
+	# paths of the requests, /<key> or /<key>/<i>
+	pattern = re.compile(r'^/([0-9a-f]{32})(?:/([0-9]+))?$')
+
+	def _file(self):
+		'''Return the file of the request path, None if invalid'''
+
+		match = self.pattern.match(self.path)
+		if match is None:
+			return None
+
+		key, i = match.groups()
+		return os.path.join(self.server.path, key[:2], key, 
+			'n' if i is None else i)
+
+	def do_HEAD(self, body=False):
+
+		path = self._file()
+		if path is None or not os.path.isfile(path):
+			self.send_error(404)
+			return
+
+		self.send_response(200)
+		self.send_header('Content-Length', str(os.path.getsize(path)))
+		self.end_headers()
+
+		if body:
+			with open(path, 'rb') as f:
+				shutil.copyfileobj(f, self.wfile)
+
+	def do_GET(self):
+
+		self.do_HEAD(True)
+
+	def do_PUT(self):
+
+		path = self._file()
+		if path is None:
+			self.send_error(400)
+			return
+
+		if not os.path.isdir(os.path.dirname(path)):
+			try:
+				os.makedirs(os.path.dirname(path))
+			except OSError as e:
+				if e.errno != errno.EEXIST:
+					raise
+
+		left = int(self.headers.getheader('Content-Length', 0))
+		fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+		with os.fdopen(fd, 'wb') as f:
+			while left > 0:
+				chunk = self.rfile.read(min(left, 1 << 20))
+				if not chunk:
+					break
+				f.write(chunk)
+				left -= len(chunk)
+
+		if left > 0:
+			os.remove(tmp)
+			self.send_error(400)
+			return
+
+		os.rename(tmp, path)
+
+		self.send_response(200)
+		self.send_header('Content-Length', '0')
+		self.end_headers()
+
+	def log_message(self, format, *args):
+
+		# NOTE: the requests are not logged, there is one per output
+		pass
+
+if __name__ == '__main__':
+	if len(sys.argv) < 2:
+		print 'usage: python depmcache.py <path> [[host:]port]'
+		sys.exit(1)
+
+	host, port = 'localhost', '8000'
+	if len(sys.argv) > 2:
+		host, _, port = sys.argv[2].rpartition(':')
+		host = host or 'localhost'
+
+	server = serve(sys.argv[1], host, int(port))
+	print 'Serving cache %s at %s:%d' % (sys.argv[1], 
+		server.server_address[0], server.server_address[1])
+	try:
+		while True:
+			time.sleep(3600)
+	except KeyboardInterrupt:
+		server.shutdown()
@@ -0,0 +1,441 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Array-backed graph of the dependency manager, for very large trees.
+
+The CSRGraph keeps the edges in compressed sparse row form: the parents of
+node i are indices[indptr[i]:indptr[i+1]], and the children likewise in a
+second pair of arrays. The state and the digest of each node are kept in
+arrays parallel to the nodes, and the digests of the parents recorded when a
+node was last updated in an array parallel to the edges, so that the hash
+table of a whole tree is checked with a few array operations.
+
+Traversal, in-degrees, descendants and the propagation of changes run as
+operations on whole arrays, one level of the tree at a time, instead of a
+method call per node. They take time proportional to the depth of the tree
+plus the number of nodes and edges at the speed of NumPy, and a tree of
+millions of nodes is built from its edges in seconds.
+
+NumPy is required, it is imported when available and the CSRGraph raises an
+ImportError otherwise. The rest of depman does not depend on this module.
+'''
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+## Module variables
+# bits of the state of a node
+DONE = 1
+DIRTY = 2
+BLOCKED = 4
+
+# dtype of the digests, the hexadecimal MD5 kept in the hash table
+DIGEST = 'S32'
+
+## Module functions
+def _ranges(starts, lens):
+	'''Return the concatenation of the ranges [starts[k], starts[k]+lens[k])'''
+
+	total = int(lens.sum())
+	offsets = numpy.cumsum(lens) - lens
+	return numpy.repeat(starts - offsets, lens) + numpy.arange(total)
+
+def _argsort(a):
+	'''Return the indices sorting a, keeping the order of equal values'''
+
+	# NOTE: the merge sort of NumPy is several times slower than its quick 
+	#		sort, which is stable once the position breaks the ties
+	if not len(a) or (numpy.diff(a) >= 0).all():
+		return numpy.arange(len(a))
+
+	key = a.astype(numpy.int64) * len(a) + numpy.arange(len(a))
+	return numpy.argsort(key, kind='quicksort')
+
+def _index_type(n):
+	'''Return the smallest index dtype holding n'''
+
+	return numpy.int32 if n < 2**31 else numpy.int64
+
+## Classes
+class CSRGraph(object):
+	"""
+	The CSRGraph is a fixed graph of n nodes, identified by their index, in
+	compressed sparse row form.
+
+	indptr is the array of n+1 offsets into indices of the parents of each
+	node, in order. The children are derived from them. Use from_edges() or
+	from_graph() to build one from a list of edges or a depman.Graph.
+
+	Along with the edges, the graph keeps,
+		- state		: bits DONE, DIRTY and BLOCKED of each node
+		- digests	: current digest of each node, set by the caller or by
+					  update() from the return value of the payloads
+		- recorded	: digest of each node when it was last updated, empty if
+					  unknown
+		- seen		: digest of each parent, parallel to indices, when its
+					  child was last updated
+		- nids		: node ids, used to load and save the hash table, or None
+	"""
+	def __init__(self, indptr, indices, nids=None):
+		super(CSRGraph, self).__init__()
+
+		if numpy is None:
+			raise ImportError('CSRGraph requires numpy')
+
+		n = len(indptr) - 1
+		itype = _index_type(n)
+
+		# parents of each node
+		self.indptr = numpy.asarray(indptr, dtype=numpy.int64)
+		self.indices = numpy.asarray(indices, dtype=itype)
+
+		# children of each node, in the order of the parents arrays
+		# NOTE: the sort is stable, so the children of a node are in
+		#		increasing order
+		self.cindptr = numpy.zeros(n + 1, dtype=numpy.int64)
+		numpy.cumsum(numpy.bincount(self.indices, minlength=n),
+			out=self.cindptr[1:])
+		order = _argsort(self.indices)
+		self.cindices = self._rows()[order].astype(itype)
+
+		self.state = numpy.zeros(n, dtype=numpy.uint8)
+		self.digests = numpy.zeros(n, dtype=DIGEST)
+		self.recorded = numpy.zeros(n, dtype=DIGEST)
+		self.seen = numpy.zeros(len(self.indices), dtype=DIGEST)
+
+		self.nids = nids
+
+	@classmethod
+	def from_edges(cls, n, parents, children, nids=None):
+		'''
+		Build a graph of n nodes from the arrays of the parent and child of
+		each edge. The parents of a node keep the order of the edges.
+		'''
+
+		if numpy is None:
+			raise ImportError('CSRGraph requires numpy')
+
+		parents = numpy.asarray(parents)
+		children = numpy.asarray(children)
+
+		indptr = numpy.zeros(n + 1, dtype=numpy.int64)
+		numpy.cumsum(numpy.bincount(children, minlength=n), out=indptr[1:])
+		indices = parents[_argsort(children)]
+
+		return cls(indptr, indices, nids)
+
+	@classmethod
+	def from_graph(cls, graph):
+		'''
+		Build a graph from the nodes registered with a depman.Graph, the index
+		of each node being the same in both
+		'''
+
+		if numpy is None:
+			raise ImportError('CSRGraph requires numpy')
+
+		def view(a):
+			'''Return a NumPy view of an array of the graph'''
+
+			# NOTE: empty buffers cannot be viewed by older NumPy
+			if not len(a):
+				return numpy.zeros(0, dtype=numpy.intc)
+			return numpy.frombuffer(a, dtype=numpy.intc)
+
+		# gather the slices of the parents, see depman.Graph
+		lens = view(graph._plen).astype(numpy.int64)
+		indptr = numpy.zeros(len(lens) + 1, dtype=numpy.int64)
+		numpy.cumsum(lens, out=indptr[1:])
+		indices = view(graph._pidx)[_ranges(view(graph._pstart), lens)]
+
+		return cls(indptr, indices, [x.nid for x in graph.nodes])
+
+	def __len__(self):
+
+		return len(self.indptr) - 1
+
+	def _rows(self):
+		'''Return the child of each edge, parallel to indices'''
+
+		n = len(self)
+		return numpy.repeat(numpy.arange(n, dtype=_index_type(n)),
+			numpy.diff(self.indptr))
+
+	def parents(self, i):
+		'''Return the array of parents of node i'''
+
+		return self.indices[self.indptr[i]:self.indptr[i+1]]
+
+	def children(self, i):
+		'''Return the array of children of node i'''
+
+		return self.cindices[self.cindptr[i]:self.cindptr[i+1]]
+
+	def _expand(self, frontier, forward=True):
+		'''Return the children, or the parents, of the nodes of frontier'''
+
+		if forward:
+			indptr, indices = self.cindptr, self.cindices
+		else:
+			indptr, indices = self.indptr, self.indices
+
+		starts = indptr[frontier]
+		return indices[_ranges(starts, indptr[frontier + 1] - starts)]
+
+	def _reach(self, nodes, forward=True):
+		'''
+		Return the mask of the nodes reached from nodes, without them unless
+		they are reached from one another
+		'''
+
+		mask = numpy.zeros(len(self), dtype=bool)
+		frontier = numpy.unique(numpy.asarray(nodes, dtype=numpy.int64))
+		while len(frontier):
+			nxt = self._expand(frontier, forward)
+			nxt = numpy.unique(nxt[~mask[nxt]])
+			mask[nxt] = True
+			frontier = nxt
+
+		return mask
+
+	def descendants(self, nodes):
+		'''Return the mask of all the (grand-)children of a list of nodes'''
+
+		return self._reach(nodes, True)
+
+	def ancestors(self, nodes):
+		'''Return the mask of all the (grand-)parents of a list of nodes'''
+
+		return self._reach(nodes, False)
+
+	def in_degree(self, mask=None):
+		'''
+		Return the number of parents of each node, only counting the parents
+		in mask if given
+		'''
+
+		if mask is None:
+			return numpy.diff(self.indptr)
+
+		rows = self._rows()
+		keep = mask[self.indices] & mask[rows]
+		return numpy.bincount(rows[keep], minlength=len(self))
+
+	def levels(self, mask=None):
+		'''
+		Return the level of each node, the length of the longest chain of
+		parents leading to it, -1 outside mask. Parents always are on a lower
+		level than their children. A ValueError is raised if mask holds a
+		cycle.
+
+		The in-degrees are decremented one level at a time, as the update of
+		depman does one node at a time.
+		'''
+
+		if mask is None:
+			mask = numpy.ones(len(self), dtype=bool)
+
+		pending = self.in_degree(mask)
+		level = numpy.empty(len(self), dtype=numpy.int32)
+		level.fill(-1)
+
+		frontier = numpy.flatnonzero(mask & (pending == 0))
+		depth = 0
+		count = 0
+		while len(frontier):
+			level[frontier] = depth
+			count += len(frontier)
+
+			nxt = self._expand(frontier)
+			nxt, k = numpy.unique(nxt[mask[nxt]], return_counts=True)
+			pending[nxt] -= k
+			frontier = nxt[pending[nxt] == 0]
+			depth += 1
+
+		if count != numpy.count_nonzero(mask):
+			raise ValueError('The graph has a cycle')
+
+		return level
+
+	def traverse(self, nodes=None):
+		'''
+		Return the array of the nodes and their (grand-)parents, parents first,
+		all the nodes if nodes is None
+		'''
+
+		return self._traverse(nodes)[0]
+
+	def _traverse(self, nodes):
+		'''Return the traversal of the nodes along with the level of each'''
+
+		if nodes is None:
+			mask = numpy.ones(len(self), dtype=bool)
+		else:
+			mask = self.ancestors(nodes)
+			mask[numpy.asarray(nodes, dtype=numpy.int64)] = True
+
+		level = self.levels(mask)
+		trv = numpy.flatnonzero(mask)
+		trv = trv[numpy.argsort(level[trv], kind='mergesort')]
+
+		return trv, level[trv]
+
+	def propagate(self, changed):
+		'''
+		Mark the changed nodes and their descendants as dirty and not done,
+		return the mask of the dirty nodes
+		'''
+
+		dirty = self.descendants(changed)
+		dirty[numpy.asarray(changed, dtype=numpy.int64)] = True
+
+		self.state[dirty] |= DIRTY
+		self.state[dirty] &= ~numpy.uint8(DONE)
+
+		return dirty
+
+	def block(self, failed):
+		'''Mark the descendants of failed nodes as blocked, return their mask'''
+
+		blocked = self.descendants(failed)
+		self.state[blocked] |= BLOCKED
+
+		return blocked
+
+	def stale(self, nodes):
+		'''
+		Return the mask of the nodes, given as an array of indices, whose
+		digest or the digest of any parent differs from the recorded ones.
+		Nodes without record are stale. This is the check of the state of a
+		node done by depman, for all the nodes at once, so their parents must
+		be up to date.
+		'''
+
+		nodes = numpy.asarray(nodes, dtype=numpy.int64)
+		out = (self.recorded[nodes] != self.digests[nodes]) | \
+			(self.recorded[nodes] == b'')
+
+		starts = self.indptr[nodes]
+		lens = self.indptr[nodes + 1] - starts
+		edges = _ranges(starts, lens)
+		changed = self.seen[edges] != self.digests[self.indices[edges]]
+		out[numpy.repeat(numpy.arange(len(nodes)), lens)[changed]] = True
+
+		return out
+
+	def record(self, nodes):
+		'''
+		Record the digests of the nodes and of their parents, as the hash
+		table does when a node is updated, and mark the nodes as done
+		'''
+
+		nodes = numpy.asarray(nodes, dtype=numpy.int64)
+		self.recorded[nodes] = self.digests[nodes]
+
+		starts = self.indptr[nodes]
+		edges = _ranges(starts, self.indptr[nodes + 1] - starts)
+		self.seen[edges] = self.digests[self.indices[edges]]
+
+		self.state[nodes] = (self.state[nodes] | DONE) & ~numpy.uint8(DIRTY)
+
+	def update(self, run, nodes=None, changed=None):
+		'''
+		Bring the nodes and their (grand-)parents up to date, all the nodes if
+		nodes is None, and return the array of the nodes run.
+
+		The nodes are taken one level at a time. The stale nodes of a level,
+		see stale(), are passed to run as an array of indices, which returns
+		the array of their new digests, e.g., after running their payloads in
+		an executor. The level is then recorded. An exception raised by run is
+		passed on, the levels done so far are kept.
+
+		changed is an optional list of nodes known to have changed. If given,
+		only the changed nodes and their descendants are checked; the other
+		nodes are taken as up to date, provided they are recorded. The nodes which
+		are not recorded run, and their descendants are checked too.
+		'''
+
+		# NOTE: the dirty nodes are marked as not done first, so that the 
+		#		nodes done by an earlier update are checked again
+		dirty = None
+		if changed is not None:
+			dirty = self.propagate(changed)
+
+		trv, level = self._traverse(nodes)
+
+		# NOTE: the nodes which are not recorded run, so their descendants are
+		#		checked as well, as depman does
+		if dirty is not None:
+			new = trv[((self.state[trv] & DONE) == 0) &
+				(self.recorded[trv] == b'')]
+			if len(new):
+				dirty |= self.propagate(new)
+
+		keep = (self.state[trv] & DONE) == 0
+
+		if dirty is not None:
+			known = self.recorded[trv] != b''
+			self.state[trv[keep & ~dirty[trv] & known]] |= DONE
+			keep &= dirty[trv] | ~known
+
+		# NOTE: the traversal is sorted by level, so each level is a slice
+		trv, level = trv[keep], level[keep]
+		bounds = numpy.flatnonzero(numpy.diff(level)) + 1
+
+		out = []
+		for wave in numpy.split(trv, bounds):
+			if not len(wave):
+				continue
+
+			todo = wave[self.stale(wave)]
+			if len(todo):
+				self.digests[todo] = run(todo)
+				out.append(todo)
+
+			self.record(wave)
+
+		if not out:
+			return numpy.zeros(0, dtype=numpy.int64)
+		return numpy.concatenate(out)
+
+	def load(self, store):
+		'''
+		Read the recorded digests from a depmdb store, by node id. A record
+		whose parents differ in number or order from those of the graph is
+		left out, so that the node is stale.
+
+		NOTE: the store is read one node at a time.
+		'''
+
+		nids = self.nids
+		for i, nid in enumerate(nids):
+			record = store.get(nid)
+			if record is None:
+				continue
+
+			hsh, parents = record
+			start, end = self.indptr[i], self.indptr[i+1]
+			if [x[0] for x in parents] != \
+				[nids[j] for j in self.indices[start:end]]:
+				continue
+
+			self.recorded[i] = hsh
+			if end > start:
+				self.seen[start:end] = [x[1] for x in parents]
+
+	def save(self, store, nodes=None):
+		'''
+		Write the recorded digests of the nodes to a depmdb store, those done
+		if nodes is None
+		'''
+
+		if nodes is None:
+			nodes = numpy.flatnonzero(self.state & DONE)
+
+		nids = self.nids
+		for i in nodes:
+			start, end = self.indptr[i], self.indptr[i+1]
+			store.put(nids[i], str(self.recorded[i]), [(nids[j], str(h)) 
+				for j, h in zip(self.indices[start:end], self.seen[start:end])])
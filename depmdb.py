@@ -0,0 +1,545 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Stores for the hash table of the dependency manager.
+
+For each node id, a store keeps the hash of the node along with the list of
+(nid, hash) pairs of its parents. For file nodes, it also keeps the stat
+signature of the file along with the hash of its contents. The wall time of 
+the last execution of the payload of each node is kept as well.
+
+Three stores are available,
+	- SqliteStore	: SQLite database in WAL mode, the parents are kept in a
+					  separate indexed table. Writes are grouped in a
+					  transaction until commit() is called.
+	- DbmStore		: dbm file with the node hash and parents packed in a
+					  comma-separated string, as used by the first versions of
+					  depman. Node ids cannot contain commas.
+	- WriteBehind	: buffer in front of another store, which groups the writes
+					  and flushes them every so many records or seconds.
+'''
+
+import os
+import dbm
+import sqlite3
+import whichdb
+import time
+import collections
+import threading
+
+## Metadata
+__author__='Pedro Inácio'
+
+## Module functions
+def open(path, backend='sqlite'):
+	'''
+	Open the store at path using backend, either 'sqlite' or 'dbm'.
+
+	The SQLite database is kept in path + '.sqlite'. If it does not exist yet
+	and there is a dbm hash table at path, the dbm hash table is migrated into
+	it. The dbm file is left untouched.
+	'''
+
+	if backend == 'dbm':
+		return DbmStore(path)
+
+	elif backend == 'sqlite':
+		db_path = path + '.sqlite'
+		legacy = not os.path.exists(db_path) and whichdb.whichdb(path)
+
+		store = SqliteStore(db_path)
+		if legacy:
+			src = DbmStore(path, 'r')
+			migrate(src, store)
+			src.close()
+
+		return store
+
+	else:
+		raise ValueError('Unknown store backend ' + str(backend))
+
+def migrate(src, dst):
+	'''Copy all the records of the store src into the store dst'''
+
+	for nid, hsh, parents in src.items():
+		dst.put(nid, hsh, parents)
+
+	for nid, sig, hsh in src.stat_items():
+		dst.put_stat(nid, sig, hsh)
+
+	for nid, seconds in src.time_items():
+		dst.put_time(nid, seconds)
+
+	dst.commit()
+
+## Module classes
+class Store(object):
+	"""
+	The Store is the interface of the hash table backends.
+
+	Records are written with put(), put_stat() and put_time(), and read back 
+	with get(), get_stat() and get_time(). The record of a node is removed 
+	with delete(). Backends may hold writes in a transaction until commit() 
+	is called; close() commits and releases the store. Stores can be used 
+	from several threads, e.g., when nodes are hashed in a thread pool.
+	"""
+	def __contains__(self, nid):
+		'''Return true if the node is in the store'''
+
+		return self.get(nid) is not None
+
+	def get(self, nid):
+		'''Return the hash and the list of (nid, hash) of the parents, or None'''
+
+		raise NotImplementedError
+
+	def put(self, nid, hsh, parents):
+		'''Write the hash of a node along with the (nid, hash) of its parents'''
+
+		raise NotImplementedError
+
+	def delete(self, nid):
+		'''Remove the hash and the parents of a node, if any'''
+
+		raise NotImplementedError
+
+	def get_stat(self, nid):
+		'''Return the stat signature and hash of a file node, or None'''
+
+		raise NotImplementedError
+
+	def put_stat(self, nid, sig, hsh):
+		'''Write the stat signature of a file node along with its hash'''
+
+		raise NotImplementedError
+
+	def get_time(self, nid):
+		'''Return the wall time of the last payload execution, or None'''
+
+		raise NotImplementedError
+
+	def put_time(self, nid, seconds):
+		'''Write the wall time of a payload execution'''
+
+		raise NotImplementedError
+
+	def items(self):
+		'''Iterate over the (nid, hash, parents) records'''
+
+		raise NotImplementedError
+
+	def stat_items(self):
+		'''Iterate over the (nid, signature, hash) records of file nodes'''
+
+		raise NotImplementedError
+
+	def time_items(self):
+		'''Iterate over the (nid, seconds) records of payload wall times'''
+
+		raise NotImplementedError
+
+	def commit(self):
+		'''Make the writes so far permanent'''
+
+		pass
+
+	def flush(self):
+		'''Make the writes so far permanent, even if buffered'''
+
+		self.commit()
+
+	def due(self):
+		'''
+		Return the number of seconds after which commit() should be called, or
+		None if there is nothing waiting to be committed
+		'''
+
+		return None
+
+	def close(self):
+		'''Commit and close the store'''
+
+		self.commit()
+
+class DbmStore(Store):
+	"""
+	Store backed by a dbm file, one comma-separated string per node.
+	"""
+	def __init__(self, path, flag='c'):
+		super(DbmStore, self).__init__()
+
+		self._db = dbm.open(path, flag)
+		self._lock = threading.Lock()
+
+	def __contains__(self, nid):
+
+		with self._lock:
+			return nid in self._db
+
+	def get(self, nid):
+
+		with self._lock:
+			if nid not in self._db:
+				return None
+			aux = self._db[nid].split(',')
+
+		hsh = aux[0]
+		parents = list()
+		for i in range(1,len(aux),2):
+			parents.append(tuple([aux[i],aux[i+1]]))
+
+		return hsh, parents
+
+	def put(self, nid, hsh, parents):
+
+		aux = str(hsh)
+		for item in parents:
+			aux += ',' + item[0] + ',' + item[1]
+
+		with self._lock:
+			self._db[nid] = aux
+
+	def delete(self, nid):
+
+		with self._lock:
+			if nid in self._db:
+				del self._db[nid]
+
+	def get_stat(self, nid):
+
+		# NOTE: the key is prefixed by a null character, which cannot be part of
+		#		a file path, so that it does not clash with the node ids
+		with self._lock:
+			if '\0' + nid not in self._db:
+				return None
+			return tuple(self._db['\0' + nid].split(','))
+
+	def put_stat(self, nid, sig, hsh):
+
+		with self._lock:
+			self._db['\0' + nid] = sig + ',' + hsh
+
+	def get_time(self, nid):
+
+		# NOTE: same as the stat signatures, with a \1 prefix
+		with self._lock:
+			if '\1' + nid not in self._db:
+				return None
+			return float(self._db['\1' + nid])
+
+	def put_time(self, nid, seconds):
+
+		with self._lock:
+			self._db['\1' + nid] = repr(float(seconds))
+
+	def items(self):
+
+		for nid in self._db.keys():
+			if not nid.startswith('\0') and not nid.startswith('\1'):
+				hsh, parents = self.get(nid)
+				yield nid, hsh, parents
+
+	def stat_items(self):
+
+		for key in self._db.keys():
+			if key.startswith('\0'):
+				sig, hsh = self.get_stat(key[1:])
+				yield key[1:], sig, hsh
+
+	def time_items(self):
+
+		for key in self._db.keys():
+			if key.startswith('\1'):
+				yield key[1:], self.get_time(key[1:])
+
+	def close(self):
+
+		with self._lock:
+			self._db.close()
+
+class SqliteStore(Store):
+	"""
+	Store backed by a SQLite database.
+
+	The database runs in WAL mode so that readers do not block the writer.
+	Node hashes, parents, stat signatures and payload wall times are kept in 
+	separate tables; the parents are indexed by the node id and their 
+	position. Writes are grouped in a single transaction until commit() is 
+	called.
+	"""
+	def __init__(self, path):
+		super(SqliteStore, self).__init__()
+
+		# NOTE: the connection is shared by the threads, using the lock
+		self._db = sqlite3.connect(path, check_same_thread=False)
+		self._lock = threading.Lock()
+
+		# NOTE: text is returned as str, node ids and hashes are plain strings
+		self._db.text_factory = str
+
+		self._db.execute('PRAGMA journal_mode=WAL')
+		self._db.execute('PRAGMA synchronous=NORMAL')
+		self._db.executescript('''
+			CREATE TABLE IF NOT EXISTS nodes (
+				nid TEXT PRIMARY KEY,
+				hash TEXT NOT NULL);
+			CREATE TABLE IF NOT EXISTS parents (
+				nid TEXT NOT NULL,
+				pos INTEGER NOT NULL,
+				parent TEXT NOT NULL,
+				hash TEXT NOT NULL,
+				PRIMARY KEY (nid, pos));
+			CREATE TABLE IF NOT EXISTS stats (
+				nid TEXT PRIMARY KEY,
+				sig TEXT NOT NULL,
+				hash TEXT NOT NULL);
+			CREATE TABLE IF NOT EXISTS times (
+				nid TEXT PRIMARY KEY,
+				seconds REAL NOT NULL);
+			''')
+
+	def __contains__(self, nid):
+
+		with self._lock:
+			return self._db.execute('SELECT 1 FROM nodes WHERE nid = ?',
+				(nid,)).fetchone() is not None
+
+	def get(self, nid):
+
+		with self._lock:
+			row = self._db.execute('SELECT hash FROM nodes WHERE nid = ?',
+				(nid,)).fetchone()
+			if row is None:
+				return None
+
+			parents = self._db.execute('SELECT parent, hash FROM parents '
+				'WHERE nid = ? ORDER BY pos', (nid,)).fetchall()
+
+		return row[0], parents
+
+	def put(self, nid, hsh, parents):
+
+		with self._lock:
+			self._db.execute('INSERT OR REPLACE INTO nodes VALUES (?, ?)',
+				(nid, str(hsh)))
+			self._db.execute('DELETE FROM parents WHERE nid = ?', (nid,))
+			self._db.executemany('INSERT INTO parents VALUES (?, ?, ?, ?)',
+				[(nid, i, x[0], x[1]) for i, x in enumerate(parents)])
+
+	def delete(self, nid):
+
+		with self._lock:
+			self._db.execute('DELETE FROM nodes WHERE nid = ?', (nid,))
+			self._db.execute('DELETE FROM parents WHERE nid = ?', (nid,))
+
+	def get_stat(self, nid):
+
+		with self._lock:
+			row = self._db.execute('SELECT sig, hash FROM stats WHERE nid = ?',
+				(nid,)).fetchone()
+		if row is None:
+			return None
+
+		return tuple(row)
+
+	def put_stat(self, nid, sig, hsh):
+
+		with self._lock:
+			self._db.execute('INSERT OR REPLACE INTO stats VALUES (?, ?, ?)',
+				(nid, sig, hsh))
+
+	def get_time(self, nid):
+
+		with self._lock:
+			row = self._db.execute('SELECT seconds FROM times WHERE nid = ?',
+				(nid,)).fetchone()
+		if row is None:
+			return None
+
+		return row[0]
+
+	def put_time(self, nid, seconds):
+
+		with self._lock:
+			self._db.execute('INSERT OR REPLACE INTO times VALUES (?, ?)',
+				(nid, float(seconds)))
+
+	def items(self):
+
+		with self._lock:
+			rows = self._db.execute('SELECT nid, hash FROM nodes').fetchall()
+		for nid, hsh in rows:
+			yield nid, hsh, self.get(nid)[1]
+
+	def stat_items(self):
+
+		with self._lock:
+			rows = self._db.execute('SELECT nid, sig, hash FROM stats').fetchall()
+		for row in rows:
+			yield row
+
+	def time_items(self):
+
+		with self._lock:
+			rows = self._db.execute('SELECT nid, seconds FROM times').fetchall()
+		for row in rows:
+			yield row
+
+	def commit(self):
+
+		with self._lock:
+			self._db.commit()
+
+	def close(self):
+
+		with self._lock:
+			self._db.commit()
+			self._db.close()
+
+class WriteBehind(Store):
+	"""
+	Write-behind buffer in front of another store.
+
+	Writes are kept in memory and flushed to store, in the order they were 
+	made and in a single transaction, once the buffer holds records writes or
+	when commit() is called at least interval seconds after the last flush. 
+	Reads see the buffered writes, deletions included.
+
+	Records of a node are only written once its update is done, so losing the 
+	buffer in a crash only means that some nodes are updated again. 
+	"""
+	def __init__(self, store, records=1000, interval=1.0):
+		super(WriteBehind, self).__init__()
+
+		self.store = store
+		self.records = records
+		self.interval = interval
+
+		# buffered writes of node, stat and time records
+		# NOTE: a deleted node record is buffered as None
+		self._nodes = collections.OrderedDict()
+		self._stats = collections.OrderedDict()
+		self._times = collections.OrderedDict()
+
+		# time of the last flush
+		self._flushed = time.time()
+
+		self._lock = threading.RLock()
+
+	def __len__(self):
+		'''Return the number of buffered records'''
+
+		return len(self._nodes) + len(self._stats) + len(self._times)
+
+	def __contains__(self, nid):
+
+		with self._lock:
+			if nid in self._nodes:
+				return self._nodes[nid] is not None
+
+			return nid in self.store
+
+	def get(self, nid):
+
+		with self._lock:
+			if nid in self._nodes:
+				return self._nodes[nid]
+
+			return self.store.get(nid)
+
+	def put(self, nid, hsh, parents):
+
+		with self._lock:
+			self._nodes[nid] = (str(hsh), list(parents))
+			if len(self) >= self.records:
+				self.flush()
+
+	def delete(self, nid):
+
+		with self._lock:
+			self._nodes[nid] = None
+			if len(self) >= self.records:
+				self.flush()
+
+	def get_stat(self, nid):
+
+		with self._lock:
+			if nid in self._stats:
+				return self._stats[nid]
+
+			return self.store.get_stat(nid)
+
+	def put_stat(self, nid, sig, hsh):
+
+		with self._lock:
+			self._stats[nid] = (sig, hsh)
+			if len(self) >= self.records:
+				self.flush()
+
+	def get_time(self, nid):
+
+		with self._lock:
+			if nid in self._times:
+				return self._times[nid]
+
+			return self.store.get_time(nid)
+
+	def put_time(self, nid, seconds):
+
+		with self._lock:
+			self._times[nid] = seconds
+			if len(self) >= self.records:
+				self.flush()
+
+	def items(self):
+
+		self.flush()
+		return self.store.items()
+
+	def stat_items(self):
+
+		self.flush()
+		return self.store.stat_items()
+
+	def time_items(self):
+
+		self.flush()
+		return self.store.time_items()
+
+	def due(self):
+
+		if not len(self):
+			return None
+
+		return max(0.0, self._flushed + self.interval - time.time())
+
+	def commit(self):
+		'''Flush the buffer if interval seconds passed since the last flush'''
+
+		if time.time() - self._flushed >= self.interval:
+			self.flush()
+
+	def flush(self):
+		'''Write the buffered records to the store'''
+
+		with self._lock:
+			for nid, record in self._nodes.iteritems():
+				if record is None:
+					self.store.delete(nid)
+				else:
+					self.store.put(nid, *record)
+			for nid, (sig, hsh) in self._stats.iteritems():
+				self.store.put_stat(nid, sig, hsh)
+			for nid, seconds in self._times.iteritems():
+				self.store.put_time(nid, seconds)
+			self.store.commit()
+
+			self._nodes.clear()
+			self._stats.clear()
+			self._times.clear()
+			self._flushed = time.time()
+
+	def close(self):
+
+		self.flush()
+		self.store.close()
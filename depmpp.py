@@ -1,7 +1,966 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Executors used by depman to run the payloads of the nodes.
+
+An executor takes a module-level function along with its arguments, runs it
+and calls back with the result, or with the exception raised, once done. The
+interface is that of multiprocessing.Pool.apply_async plus an error callback.
+Executors can also run a batch of calls as a single task, which saves the 
+round trip of each call for tiny functions. A call can be given a timeout, 
+after which it fails with a multiprocessing.TimeoutError and the worker 
+running it is killed, if the backend allows it. The backends are,
+	- ProcessExecutor		: pool of worker processes, for CPU bound payloads
+	- ThreadExecutor		: pool of threads, for I/O bound payloads which do
+							  not need to be pickled and sent to a process
+	- InlineExecutor		: runs the function right away in the calling
+							  thread, for tiny payloads
+	- SubprocessExecutor	: runs each function in a new process, so that a
+							  crash or a leak only affects one payload
+	- FuturesExecutor		: wraps a concurrent.futures executor, e.g., a
+							  ProcessPoolExecutor of the futures package
+	- DistributedExecutor	: sends the functions to worker daemons, possibly
+							  on other machines, see run_worker
+
+A worker daemon connecting to a DistributedExecutor listening at host:port is
+started by
+	DEPMAN_AUTHKEY=<key> python depmpp.py host:port [np]
+The functions and their arguments are sent as pickles, which run code when 
+loaded, so the executor and the workers only talk to peers knowing the same 
+secret key.
+'''
+
 import multiprocessing
+import multiprocessing.pool
+import traceback
+import threading
+import itertools
+import signal
+import os
+import sys
+import time
+import socket
+import collections
+import multiprocessing.connection
+
+## Metadata
+__author__='Pedro Inácio'
 
+## Module variables
+# executors wrapping pools created by the user, keyed by id of the pool
+_wrapped = dict()
+
+# queue to stream the results of batches from the worker processes, set by 
+# _init_worker in the processes of a ProcessExecutor
+_results = None
+
+## Module functions
 def init(np=None):
 	'''Return a pool of work processes. If np is None, then the available number
 	of processors in the machine is used'''
 
-	return multiprocessing.Pool(np)
+	return ProcessExecutor(np)
+
+def executor(pool):
+	'''
+	Return the executor of pool. Executors are returned as they are, pools from
+	multiprocessing are wrapped in a PoolExecutor.
+	'''
+
+	if pool is None or isinstance(pool, Executor):
+		return pool
+
+	if id(pool) not in _wrapped:
+		_wrapped[id(pool)] = PoolExecutor(pool)
+
+	return _wrapped[id(pool)]
+
+def _call(func, args):
+	'''
+	Call func with args, return a tuple with True and the result, or with False
+	and the traceback if an exception was raised. A timeout is returned as the
+	multiprocessing.TimeoutError raised, see Executor.apply_async.
+	'''
+
+	try:
+		return True, func(*args)
+	except multiprocessing.TimeoutError as e:
+		return False, e
+	except Exception:
+		return False, traceback.format_exc()
+
+def _call_batch(bid, func, argslist):
+	'''
+	Call func with each args of argslist, return the list of results of _call.
+	Each result is also put in the results queue, if any, as soon as it is 
+	ready, along with bid and its position in the batch.
+	'''
+
+	out = []
+	for i, args in enumerate(argslist):
+		out.append(_call(func, args))
+		if _results is not None and bid is not None:
+			_results.put((bid, i, out[-1]))
+
+	return out
+
+def _call_started(start, func, args):
+	'''Call start, then func with args'''
+
+	start()
+	return func(*args)
+
+def _call_timed(token, func, args):
+	'''
+	Call func with args, after telling the process running it through the 
+	results queue, if any, along with token
+	'''
+
+	if _results is not None:
+		_results.put((None, token, os.getpid()))
+
+	return func(*args)
+
+def _init_worker(results):
+	'''Initializer of the worker processes of a ProcessExecutor'''
+
+	global _results
+	_results = results
+
+def _spawn(func, args, procs=None, timeout=None, stop=None):
+	'''
+	Call func with args in a new process and return the result. The process is
+	kept in the set procs, if given, while it runs. If it runs for more than 
+	timeout seconds, it is terminated and multiprocessing.TimeoutError raised.
+	If the event stop is given and set, the process is terminated as well.
+	'''
+
+	recv, send = multiprocessing.Pipe(False)
+	p = multiprocessing.Process(target=_child, args=(send, func, args))
+	p.start()
+	send.close()
+
+	if procs is not None:
+		procs.add(p)
+
+	# NOTE: stop is set before the processes in procs are terminated, so a 
+	#		process started meanwhile is terminated either there or here
+	if stop is not None and stop.is_set():
+		p.terminate()
+
+	try:
+		if timeout is not None and not recv.poll(timeout):
+			p.terminate()
+			p.join()
+			raise multiprocessing.TimeoutError('Process timed out after ' + 
+				str(timeout) + ' seconds')
+		success, value = recv.recv()
+	except EOFError:
+		p.join()
+		raise RuntimeError('Process exited with code ' + str(p.exitcode))
+	finally:
+		if procs is not None:
+			procs.discard(p)
+
+	p.join()
+	if not success:
+		raise RuntimeError(value)
+
+	return value
+
+def _authkey(authkey):
+	'''
+	Return the key authenticating the connections of the workers, given or 
+	else in the DEPMAN_AUTHKEY environment variable. A ValueError is raised 
+	if there is none.
+	'''
+
+	if authkey is None:
+		authkey = os.environ.get('DEPMAN_AUTHKEY')
+	if not authkey:
+		raise ValueError('An authkey is required, pass one or set '
+			'DEPMAN_AUTHKEY')
+
+	return authkey
+
+def _child(conn, func, args):
+	'''Entry point of the processes created by _spawn'''
+
+	conn.send(_call(func, args))
+	conn.close()
+
+def run_worker(address, authkey=None, np=None, heartbeat=1.0):
+	'''
+	Run a worker daemon for the DistributedExecutor listening at address, a 
+	(host, port) tuple, until the connection is lost. The connection is 
+	authenticated with authkey, see _authkey. The worker registers a capacity
+	of np calls at a time, the number of processors if None, runs the calls 
+	in a ProcessExecutor and sends a heartbeat every heartbeat seconds. The 
+	functions sent must be importable by the worker.
+	'''
+
+	authkey = _authkey(authkey)
+	if np is None:
+		np = multiprocessing.cpu_count()
+
+	conn = multiprocessing.connection.Client(address, authkey=authkey)
+	lock = threading.Lock()
+
+	def send(msg):
+		with lock:
+			conn.send(msg)
+
+	executor = ProcessExecutor(np)
+	stop = threading.Event()
+
+	def beat():
+		while not stop.wait(heartbeat):
+			try:
+				send(('heartbeat',))
+			except (IOError, EOFError):
+				return
+
+	t = threading.Thread(target=beat)
+	t.daemon = True
+	t.start()
+
+	send(('register', np, socket.gethostname()))
+	try:
+		while True:
+			try:
+				msg = conn.recv()
+			except (IOError, EOFError):
+				break
+
+			if msg[0] == 'call':
+				cid, func, args, timeout = msg[1:]
+				executor.apply_async(func, args, 
+					callback=lambda x, cid=cid: send(('result', cid, True, x)),
+					error_callback=lambda x, cid=cid: send(('result', cid, 
+						False, str(x))), timeout=timeout)
+			elif msg[0] == 'cancel':
+				executor.cancel()
+			elif msg[0] == 'close':
+				break
+	finally:
+		stop.set()
+		executor.cancel()
+		executor.close()
+		conn.close()
+
+## Module classes
+class Executor(object):
+	"""
+	The Executor is the interface of the backends running the payloads.
+	"""
+	def apply_async(self, func, args=(), callback=None, error_callback=None,
+		timeout=None):
+		'''
+		Run func(*args) asynchronously. Once done, callback is called with the
+		result or, if an exception was raised, error_callback is called with
+		it. The callbacks may be called from another thread.
+
+		If timeout is given and the call runs for more than timeout seconds, 
+		error_callback is called with a multiprocessing.TimeoutError and the
+		result of the call, if any, is ignored. The backends which can kill 
+		the worker running the call do so, and replace it.
+		'''
+
+		raise NotImplementedError
+
+	def apply_batch(self, func, argslist, callback=None, error_callback=None):
+		'''
+		Run func(*args) asynchronously for each args in argslist. Once each
+		call is done, callback is called with its position in argslist and 
+		the result, or error_callback with the position and the exception.
+
+		This implementation submits each call on its own, backends with a
+		round trip cost run the whole batch as a single task.
+		'''
+
+		for i, args in enumerate(argslist):
+			self.apply_async(func, args,
+				None if callback is None else 
+					lambda x, i=i: callback(i, x),
+				None if error_callback is None else 
+					lambda x, i=i: error_callback(i, x))
+
+	def cancel(self):
+		'''
+		Cancel the calls submitted and not done, as far as the backend allows.
+		The callbacks of the cancelled calls are not called. The executor can
+		be used again afterwards.
+		'''
+
+		pass
+
+	def close(self):
+		'''Release the resources of the executor once the work is done'''
+
+		pass
+
+	def _timed(self, callback, error_callback, timeout, kill=None):
+		'''
+		Return the callbacks of a call with a timeout, along with a function 
+		starting its clock. If the callbacks are not called within timeout 
+		seconds of the start, kill is called, if given, and error_callback with
+		a multiprocessing.TimeoutError. Only the first callback goes through.
+		'''
+
+		lock = threading.Lock()
+		over = [False]
+		timer = [None]
+
+		def first():
+			'''Return true the first time it is called'''
+
+			with lock:
+				if over[0]:
+					return False
+				over[0] = True
+				if timer[0] is not None:
+					timer[0].cancel()
+				return True
+
+		def expire():
+			if first():
+				if kill is not None:
+					kill()
+				if error_callback is not None:
+					error_callback(multiprocessing.TimeoutError(
+						'Call timed out after ' + str(timeout) + ' seconds'))
+
+		def start():
+			with lock:
+				if not over[0]:
+					timer[0] = threading.Timer(timeout, expire)
+					timer[0].daemon = True
+					timer[0].start()
+
+		def done(x):
+			if first() and callback is not None:
+				callback(x)
+
+		def failed(x):
+			if first() and error_callback is not None:
+				error_callback(x)
+
+		return done, failed, start
+
+	def _done(self, result, callback, error_callback):
+		'''Dispatch the result of _call to the callbacks'''
+
+		success, value = result
+		if success:
+			if callback is not None:
+				callback(value)
+		elif error_callback is not None:
+			error_callback(value if isinstance(value, Exception) else 
+				RuntimeError(value))
+
+class PoolExecutor(Executor):
+	"""
+	Executor running the functions in a pool from multiprocessing, either a
+	Pool of processes or a ThreadPool.
+	"""
+	def __init__(self, pool):
+		super(PoolExecutor, self).__init__()
+
+		self.pool = pool
+
+	def apply_async(self, func, args=(), callback=None, error_callback=None,
+		timeout=None):
+		'''
+		A call with a timeout is not killed. In a ThreadPool, its clock starts
+		when a thread picks it up, in a Pool when it is submitted.
+		'''
+
+		if timeout is not None:
+			callback, error_callback, start = self._timed(callback, 
+				error_callback, timeout)
+			if isinstance(self.pool, multiprocessing.pool.ThreadPool):
+				func, args = _call_started, (start, func, args)
+			else:
+				start()
+
+		# NOTE: the calls of a pool replaced by cancel() are not called back
+		pool = self.pool
+
+		def done(x):
+			if pool is self.pool:
+				self._done(x, callback, error_callback)
+
+		# NOTE: _call catches the exceptions, the pools of python 2 do not call
+		#		back when the function fails
+		return pool.apply_async(_call, (func, args), callback=done)
+
+	def apply_batch(self, func, argslist, callback=None, error_callback=None):
+		'''
+		Run the batch as a single task of the pool, the callbacks are called 
+		once the whole batch is done
+		'''
+
+		pool = self.pool
+
+		def done(result):
+			if pool is not self.pool:
+				return
+
+			success, value = result
+			if not success:
+				value = [result] * len(argslist)
+			for i, x in enumerate(value):
+				self._done(x, 
+					None if callback is None else lambda y: callback(i, y),
+					None if error_callback is None else 
+						lambda y: error_callback(i, y))
+
+		return pool.apply_async(_call, (_call_batch, 
+			(None, func, argslist)), callback=done)
+
+	def cancel(self):
+		'''
+		Terminate the pool, killing its worker processes, and replace it with 
+		a new one of the same size. The calls queued are dropped; the calls 
+		running in a ThreadPool run to completion, but are not called back.
+		'''
+
+		pool = self.pool
+		self.pool = self._new_pool(pool)
+
+		# NOTE: terminating a pool waits for its handler threads, which poll 
+		#		every tenth of a second, so it is done in the background
+		t = threading.Thread(target=pool.terminate)
+		t.daemon = True
+		t.start()
+
+	def close(self):
+
+		self.pool.close()
+		self.pool.join()
+
+	def _new_pool(self, pool):
+		'''Return a new pool like pool'''
+
+		return type(pool)(pool._processes, pool._initializer, pool._initargs)
+
+class ProcessExecutor(PoolExecutor):
+	"""
+	Executor running the functions in a pool of np processes, the number of
+	processors in the machine if np is None. The functions and their arguments
+	must be pickled, therefore the functions must be module-level functions.
+
+	The results of the calls in a batch are streamed back from the worker as 
+	each call is done, through a queue shared with the workers. So are the 
+	workers starting the calls with a timeout, which are killed once the call
+	times out; the pool replaces them.
+	"""
+	def __init__(self, np=None):
+
+		self.np = np
+
+		# callbacks of the batches running, keyed by batch id, along with the
+		# positions of the calls already called back
+		self._batches = dict()
+		self._ids = itertools.count()
+		self._lock = threading.Lock()
+
+		# calls with a timeout, keyed by token, along with the function 
+		# starting their clock, their pool and async result, and the process
+		# running them once started
+		self._timed_calls = dict()
+
+		# queue of the results of the batches of the pool, see _new_pool
+		self._queue = None
+
+		super(ProcessExecutor, self).__init__(self._new_pool(None))
+
+	def apply_async(self, func, args=(), callback=None, error_callback=None,
+		timeout=None):
+		'''
+		The clock of a call with a timeout starts when a worker picks it up, 
+		the worker is killed when it times out
+		'''
+
+		if timeout is None:
+			return super(ProcessExecutor, self).apply_async(func, args, 
+				callback, error_callback)
+
+		token = next(self._ids)
+		callback, error_callback, start = self._timed(callback, error_callback,
+			timeout, lambda: self._kill(token))
+
+		def done(x):
+			with self._lock:
+				self._timed_calls.pop(token, None)
+			self._done(x, callback, error_callback)
+
+		with self._lock:
+			pool = self.pool
+			self._timed_calls[token] = [start, pool, None, None]
+			result = self._timed_calls[token][2] = pool.apply_async(_call, 
+				(_call_timed, (token, func, args)), callback=done)
+
+		return result
+
+	def cancel(self):
+
+		results = self._queue
+		super(ProcessExecutor, self).cancel()
+		self._stop_reader(results)
+
+		with self._lock:
+			self._batches.clear()
+			self._timed_calls.clear()
+
+	def close(self):
+
+		super(ProcessExecutor, self).close()
+		self._stop_reader(self._queue)
+
+	def _new_pool(self, pool):
+		'''
+		Return a new pool along with a new queue of the results of batches, 
+		kept in _queue and read by a thread of this process
+		'''
+
+		# NOTE: a worker killed while writing to the queue leaves it unusable,
+		#		so each pool gets its own queue
+		results = self._queue = multiprocessing.Queue()
+
+		reader = threading.Thread(target=self._read_results, args=(results,))
+		reader.daemon = True
+		reader.start()
+
+		return multiprocessing.Pool(self.np, _init_worker, (results,))
+
+	def _stop_reader(self, results):
+		'''Stop the thread reading the queue results, then close the queue'''
+
+		# NOTE: the queue may be unusable, see _new_pool, in which case the 
+		#		reader is left waiting; the sentinel is then dropped at exit 
+		#		rather than waited for
+		results.put(None)
+		results.close()
+		results.cancel_join_thread()
+
+	def apply_batch(self, func, argslist, callback=None, error_callback=None):
+		'''
+		Run the batch as a single task of the pool, the callbacks of each call 
+		are called as soon as the worker is done with it
+		'''
+
+		bid = next(self._ids)
+		with self._lock:
+			self._batches[bid] = (callback, error_callback, set(), 
+				len(argslist))
+
+		# NOTE: the results are also returned at the end of the batch, in 
+		#		case they are not all streamed, e.g., when the queue fails
+		def done(result):
+			success, value = result
+			if not success:
+				value = [result] * len(argslist)
+			for i, x in enumerate(value):
+				self._result(bid, i, x)
+
+		return self.pool.apply_async(_call, (_call_batch, 
+			(bid, func, argslist)), callback=done)
+
+	def _read_results(self, results):
+		'''Read the streamed results of the batches, run by a thread'''
+
+		while True:
+			try:
+				item = results.get()
+			except (EOFError, IOError):
+				return
+
+			# the sentinel of _stop_reader
+			if item is None:
+				return
+
+			bid, i, result = item
+			if bid is None:
+				self._started(i, result)
+			else:
+				self._result(bid, i, result)
+
+	def _started(self, token, pid):
+		'''Start the clock of the call with a timeout token, run by pid'''
+
+		with self._lock:
+			if token not in self._timed_calls:
+				return
+			self._timed_calls[token][3] = pid
+			start = self._timed_calls[token][0]
+
+		start()
+
+	def _kill(self, token):
+		'''Kill the worker running the call with a timeout token'''
+
+		with self._lock:
+			if token not in self._timed_calls:
+				return
+			start, pool, result, pid = self._timed_calls.pop(token)
+
+		# NOTE: the pool starts a new worker in place of the killed one, but it
+		#		waits for the results of all the calls submitted when closed, so
+		#		the killed call is dropped
+		pool._cache.pop(result._job, None)
+		try:
+			os.kill(pid, signal.SIGKILL)
+		except OSError:
+			pass
+
+	def _result(self, bid, i, result):
+		'''Call back with the result of call i of batch bid, only once'''
+
+		with self._lock:
+			if bid not in self._batches:
+				return
+			callback, error_callback, seen, n = self._batches[bid]
+			if i in seen:
+				return
+			seen.add(i)
+			if len(seen) == n:
+				del self._batches[bid]
+
+		self._done(result, 
+			None if callback is None else lambda y: callback(i, y),
+			None if error_callback is None else lambda y: error_callback(i, y))
+
+class ThreadExecutor(PoolExecutor):
+	"""
+	Executor running the functions in a pool of n threads. Nothing is pickled,
+	which makes it cheaper than processes for payloads waiting on I/O.
+	"""
+	def __init__(self, n=4):
+		super(ThreadExecutor, self).__init__(multiprocessing.pool.ThreadPool(n))
+
+	# NOTE: a thread cannot be killed, a call which times out keeps its thread
+	#		until it returns
+
+	# NOTE: there is no round trip to save, each call runs on its own
+	apply_batch = Executor.apply_batch
+
+class InlineExecutor(Executor):
+	"""
+	Executor running the functions right away in the calling thread. There is
+	no parallelism, nor any overhead. Timeouts are ignored.
+	"""
+	def apply_async(self, func, args=(), callback=None, error_callback=None,
+		timeout=None):
+
+		self._done(_call(func, args), callback, error_callback)
+
+class SubprocessExecutor(PoolExecutor):
+	"""
+	Executor running each function in a new process, at most n at a time. A
+	process which crashes only fails its own function, and the memory used by
+	a function is released when it returns.
+	"""
+	def __init__(self, n=None):
+		if n is None:
+			n = multiprocessing.cpu_count()
+
+		super(SubprocessExecutor, self).__init__(
+			multiprocessing.pool.ThreadPool(n))
+
+		# processes running, and the event set when they are cancelled
+		self._procs = set()
+		self._stop = threading.Event()
+
+	def apply_async(self, func, args=(), callback=None, error_callback=None,
+		timeout=None):
+		'''The process of a call is terminated when it times out'''
+
+		return super(SubprocessExecutor, self).apply_async(_spawn,
+			(func, args, self._procs, timeout, self._stop), callback, 
+			error_callback)
+
+	def cancel(self):
+		'''Drop the calls queued and terminate the processes running'''
+
+		# NOTE: the pool is replaced first, so that the calls terminated are 
+		#		not called back. A call queued may still be picked up until the
+		#		pool is terminated, its process is then terminated as it starts
+		self._stop.set()
+		self._stop = threading.Event()
+		super(SubprocessExecutor, self).cancel()
+
+		for p in list(self._procs):
+			p.terminate()
+
+	# NOTE: each call runs in its own process
+	apply_batch = Executor.apply_batch
+
+class FuturesExecutor(Executor):
+	"""
+	Executor wrapping a concurrent.futures executor, e.g., ProcessPoolExecutor
+	or ThreadPoolExecutor from the futures package.
+	"""
+	def __init__(self, executor):
+		super(FuturesExecutor, self).__init__()
+
+		self.executor = executor
+
+		# futures not done yet
+		self._futures = set()
+
+	def apply_async(self, func, args=(), callback=None, error_callback=None,
+		timeout=None):
+		'''
+		The clock of a call with a timeout starts when it is submitted, the 
+		call is cancelled when it times out, if it is not running yet
+		'''
+
+		start = None
+		future = self.executor.submit(_call, func, args)
+		if timeout is not None:
+			callback, error_callback, start = self._timed(callback, 
+				error_callback, timeout, future.cancel)
+		self._futures.add(future)
+
+		def done(f):
+			self._futures.discard(f)
+			if not f.cancelled():
+				self._done(f.result() if f.exception() is None else 
+					(False, str(f.exception())), callback, error_callback)
+
+		future.add_done_callback(done)
+		if start is not None:
+			start()
+
+		return future
+
+	def cancel(self):
+		'''
+		Cancel the futures which did not start, those running run to 
+		completion and are called back
+		'''
+
+		for f in list(self._futures):
+			f.cancel()
+
+	def close(self):
+
+		self.executor.shutdown()
+
+class DistributedExecutor(Executor):
+	"""
+	Executor sending the functions to worker daemons, see run_worker, which 
+	connect to it at address, a (host, port) tuple, any free port if 0. The 
+	address is in the address attribute once listening. The connections are 
+	authenticated with authkey, which is required, or else taken from the 
+	DEPMAN_AUTHKEY environment variable.
+
+	Each worker registers the number of calls it runs at a time, the calls 
+	are sent to the workers with free capacity in the order submitted, and 
+	wait for one otherwise. A worker which closes its connection, or does not
+	send a heartbeat for timeout seconds, is dropped and its calls are sent to
+	the other workers. The functions and their arguments are pickled, so they
+	must be module-level functions importable by the workers.
+	"""
+	def __init__(self, address=('localhost', 0), authkey=None, timeout=10.0):
+		super(DistributedExecutor, self).__init__()
+
+		authkey = _authkey(authkey)
+
+		self.timeout = timeout
+
+		# calls waiting for a worker, keyed by call id along with the function, 
+		# the arguments, the timeout and the callbacks
+		self._calls = dict()
+		self._pending = collections.deque()
+		self._ids = itertools.count()
+
+		# workers connected, keyed by id of their connection, and the lock of 
+		# the state of the calls and the workers
+		self._workers = dict()
+		self._lock = threading.Lock()
+
+		self._listener = multiprocessing.connection.Listener(address, 
+			authkey=authkey)
+		self.address = self._listener.address
+		self._closed = False
+
+		for target in [self._accept, self._monitor]:
+			t = threading.Thread(target=target)
+			t.daemon = True
+			t.start()
+
+	def capacity(self):
+		'''Return the number of calls the workers connected run at a time'''
+
+		with self._lock:
+			return sum([w['np'] for w in self._workers.itervalues()])
+
+	def apply_async(self, func, args=(), callback=None, error_callback=None,
+		timeout=None):
+		'''A call with a timeout runs with that timeout in its worker'''
+
+		with self._lock:
+			cid = next(self._ids)
+			self._calls[cid] = (func, args, timeout, callback, error_callback)
+			self._pending.append(cid)
+			self._dispatch()
+
+	def apply_batch(self, func, argslist, callback=None, error_callback=None):
+		'''
+		Run the batch as a single call, the callbacks are called once the whole
+		batch is done
+		'''
+
+		def done(value):
+			for i, x in enumerate(value):
+				self._done(x, 
+					None if callback is None else lambda y: callback(i, y),
+					None if error_callback is None else 
+						lambda y: error_callback(i, y))
+
+		def failed(error):
+			if error_callback is not None:
+				for i in range(len(argslist)):
+					error_callback(i, error)
+
+		self.apply_async(_call_batch, (None, func, argslist), done, failed)
+
+	def cancel(self):
+		'''Drop the calls waiting and cancel those running in the workers'''
+
+		with self._lock:
+			self._calls.clear()
+			self._pending.clear()
+			for w in self._workers.values():
+				w['calls'].clear()
+				self._send(w, ('cancel',))
+
+	def close(self):
+		'''Stop listening and let the workers go'''
+
+		self._closed = True
+		self._listener.close()
+		with self._lock:
+			for w in self._workers.values():
+				self._send(w, ('close',))
+				w['conn'].close()
+			self._workers.clear()
+
+	def _send(self, worker, msg):
+		'''Send msg to worker, return false if the connection failed'''
+
+		try:
+			worker['conn'].send(msg)
+			return True
+		except (IOError, EOFError, socket.error):
+			return False
+
+	def _dispatch(self):
+		'''Send the calls waiting to the workers with free capacity, locked'''
+
+		for w in self._workers.values():
+			while self._pending and len(w['calls']) < w['np']:
+				cid = self._pending.popleft()
+				if cid not in self._calls:
+					continue
+				func, args, timeout = self._calls[cid][:3]
+				w['calls'].add(cid)
+				if not self._send(w, ('call', cid, func, args, timeout)):
+					# NOTE: the worker is dropped by its reader thread
+					break
+
+	def _accept(self):
+		'''Accept the connections of the workers, run by a thread'''
+
+		while True:
+			try:
+				conn = self._listener.accept()
+			except Exception:
+				# the listener was closed, or the worker failed to authenticate
+				if self._closed:
+					return
+				continue
+
+			t = threading.Thread(target=self._serve, args=(conn,))
+			t.daemon = True
+			t.start()
+
+	def _serve(self, conn):
+		'''Read the messages of a worker, run by a thread per worker'''
+
+		worker = None
+		try:
+			while True:
+				msg = conn.recv()
+
+				if msg[0] == 'register':
+					with self._lock:
+						worker = {'conn': conn, 'np': msg[1], 'host': msg[2], 
+							'calls': set(), 'seen': time.time()}
+						self._workers[id(conn)] = worker
+						self._dispatch()
+					continue
+
+				if worker is None:
+					continue
+				worker['seen'] = time.time()
+
+				if msg[0] == 'result':
+					cid, success, value = msg[1:]
+					with self._lock:
+						if cid not in worker['calls']:
+							continue
+						worker['calls'].discard(cid)
+						callback, error_callback = self._calls.pop(cid)[3:]
+						self._dispatch()
+
+					if success:
+						if callback is not None:
+							callback(value)
+					elif error_callback is not None:
+						error_callback(RuntimeError(value))
+
+		except (IOError, EOFError, socket.error):
+			pass
+
+		finally:
+			self._drop(conn)
+
+	def _drop(self, conn):
+		'''Drop the worker of conn, its calls are sent to the others'''
+
+		with self._lock:
+			worker = self._workers.pop(id(conn), None)
+			if worker is not None:
+				self._pending.extendleft(sorted(worker['calls'], reverse=True))
+				worker['calls'].clear()
+				self._dispatch()
+
+		try:
+			conn.close()
+		except (IOError, OSError):
+			pass
+
+	def _monitor(self):
+		'''Drop the workers without heartbeat, run by a thread'''
+
+		while not self._closed:
+			time.sleep(min(1.0, self.timeout/4))
+			with self._lock:
+				late = [w['conn'] for w in self._workers.itervalues() 
+					if time.time() - w['seen'] > self.timeout]
+
+			# NOTE: closing the connection makes its reader thread drop it
+			for conn in late:
+				self._drop(conn)
+
+if __name__ == '__main__':
+	if len(sys.argv) < 2 or not os.environ.get('DEPMAN_AUTHKEY'):
+		print 'usage: DEPMAN_AUTHKEY=<key> python depmpp.py host:port [np]'
+		sys.exit(1)
+
+	host, port = sys.argv[1].rsplit(':', 1)
+	run_worker((host, int(port)), 
+		np=int(sys.argv[2]) if len(sys.argv) > 2 else None)
@@ -0,0 +1,1142 @@
+# unit tests of the dependency manager, run with
+#	python -m unittest test_depman
+import depman
+import depmpp
+import depmcache
+import depmcsr
+import depmdb
+import dbm
+import hashlib
+import os
+import signal
+import sys
+import multiprocessing
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+import weakref
+import gc
+
+try:
+	import concurrent.futures as futures
+except ImportError:
+	futures = None
+
+depman.DEBUG = False
+
+# nodes run by the payloads, in order, the hash of each KNode by node id, 
+# the number of calls of the flaky payload by node id and the ids of the nodes
+# made to fail
+LOG = []
+KEYS = dict()
+CALLS = dict()
+BROKEN = set()
+_lock = threading.Lock()
+
+# directory of the files written by the payloads
+DIR = None
+
+# Functions
+def payload(nid):
+	with _lock:
+		LOG.append(nid)
+	return True
+
+def failing(nid):
+	'''Fail the nodes whose id starts with bad or is in BROKEN'''
+
+	with _lock:
+		LOG.append(nid)
+	return not nid.startswith('bad') and nid not in BROKEN
+
+def flaky(nid):
+	'''Fail the first two calls'''
+
+	with _lock:
+		CALLS[nid] = CALLS.get(nid, 0) + 1
+		return CALLS[nid] > 2
+
+def sleepy(nid):
+	time.sleep(2.0)
+	return True
+
+def nap(nid):
+	time.sleep(0.2)
+	return True
+
+def work(nid):
+	'''Sleep, then write the pid of the process to a file named nid'''
+
+	time.sleep(0.2)
+	open(os.path.join(DIR, nid), 'w').write(str(os.getpid()))
+	return True
+
+def upper(nid):
+	with _lock:
+		LOG.append(nid)
+	data = open(os.path.join(DIR, 'src.txt')).read()
+	open(os.path.join(DIR, 'out.txt'), 'w').write(data.upper())
+	return True
+
+def boom():
+	raise ValueError('boom')
+
+def die():
+	os._exit(3)
+
+def echo(x):
+	return x
+
+def spoil(nid):
+	'''Make the hash of the node raise once the payload ran'''
+
+	with _lock:
+		LOG.append(nid)
+		KEYS[nid] = IOError(13, 'Permission denied')
+	return True
+
+class KNode(depman.Node):
+	"""Node whose hash is set in KEYS, its node id by default, or raised"""
+	def hash(self):
+		key = KEYS.get(self.nid, self.nid)
+		if isinstance(key, Exception):
+			raise key
+		return key
+
+class SlowCache(depmcache.Cache):
+	"""Cache taking a while to look up its entries"""
+	def get(self, key, paths):
+		time.sleep(0.3)
+		with _lock:
+			LOG.append('get')
+		return depmcache.Cache.get(self, key, paths)
+
+class SlowUploads(depmcache.RemoteCache):
+	"""Remote cache taking a while to upload its entries"""
+	def _upload(self, key):
+		time.sleep(1.0)
+		return depmcache.RemoteCache._upload(self, key)
+
+# Classes
+class TestCase(unittest.TestCase):
+	"""Base of the tests, with a graph, an executor and a hash table"""
+	def setUp(self):
+		global DIR
+		DIR = self.dir = tempfile.mkdtemp()
+		del LOG[:]
+		KEYS.clear()
+		CALLS.clear()
+		BROKEN.clear()
+
+		self.graph = depman.Graph()
+		self.ex = depmpp.ThreadExecutor(4)
+		self.sessions = []
+
+	def tearDown(self):
+		for s in self.sessions:
+			s.close()
+		shutil.rmtree(self.dir)
+
+	def session(self, **kwargs):
+		'''Return a session keeping its hash table in the test directory'''
+
+		s = depman.Session(os.path.join(self.dir, 'db'), **kwargs)
+		self.sessions.append(s)
+		return s
+
+	def node(self, parents=[], nid=None, payload=payload, **kwargs):
+		'''Return a KNode of the graph of the test'''
+
+		kwargs.setdefault('graph', self.graph)
+		return KNode(self.ex, parents, nid, payload, **kwargs)
+
+	def chain(self, n, prefix='c', **kwargs):
+		'''Return a chain of n nodes, each depending on the previous one'''
+
+		nodes = [self.node(nid=prefix + '0', **kwargs)]
+		for i in range(1, n):
+			nodes.append(self.node(nodes[-1], prefix + str(i), **kwargs))
+		return nodes
+
+class TestUpdate(TestCase):
+	def test_order(self):
+		a, b, c = self.chain(3)
+		d = self.node([a, c], 'd')
+		self.session().update(d)
+
+		self.assertEqual(LOG, ['c0', 'c1', 'c2', 'd'])
+		self.assertTrue(all([x.is_updated() for x in [a, b, c, d]]))
+
+	def test_unchanged(self):
+		s = self.session()
+		s.update(self.chain(3)[-1])
+
+		# the same nodes in a new graph are up to date
+		del LOG[:]
+		self.graph = depman.Graph()
+		s.update(self.chain(3)[-1])
+		self.assertEqual(LOG, [])
+
+		# a changed node runs along with its descendants
+		KEYS['c1'] = 'new'
+		self.graph = depman.Graph()
+		s.update(self.chain(3)[-1])
+		self.assertEqual(LOG, ['c1', 'c2'])
+
+	def test_changed_twice(self):
+		a, b, c = self.chain(3)
+		s = self.session()
+		s.update(c)
+
+		# the same nodes are updated again in the same process, as a file 
+		# watcher does
+		KEYS['c0'] = 'new'
+		del LOG[:]
+		s.update(c, changed=[a])
+		self.assertEqual(LOG, ['c0', 'c1'])
+		self.assertEqual(s.store.get('c1')[1], [('c0', 'new')])
+
+		KEYS['c1'] = 'newer'
+		del LOG[:]
+		s.update(c, changed=b)
+		self.assertEqual(LOG, ['c1', 'c2'])
+		self.assertTrue(all([x.is_updated() for x in [a, b, c]]))
+
+		# nothing changed
+		del LOG[:]
+		s.update(c, changed=[])
+		self.assertEqual(LOG, [])
+
+	def test_failed_changed(self):
+		a, b, c = self.chain(3, payload=failing)
+		s = self.session()
+		s.update(c)
+
+		# the failed node and the node it blocked are left out of date
+		KEYS['c0'] = 'new'
+		BROKEN.add('c1')
+		failures = s.update(c, changed=[a], keep_going=True)
+		self.assertEqual(failures, {'c1': ['c2']})
+		self.assertEqual(s.store.get('c1'), None)
+
+		BROKEN.clear()
+		del LOG[:]
+		s.update(c, changed=[])
+		self.assertEqual(LOG, ['c1', 'c2'])
+		self.assertEqual(s.store.get('c1')[1], [('c0', 'new')])
+
+	def test_raise_changed(self):
+		s = self.session()
+		s.update(self.chain(3, payload=failing)[-1])
+
+		KEYS['c0'] = 'new'
+		BROKEN.add('c1')
+		a, b, c = self.chain(3, payload=failing)
+		self.assertRaises(RuntimeError, s.update, c, changed=[a])
+		s.close()
+
+		# another process updates the nodes
+		BROKEN.clear()
+		del LOG[:]
+		self.graph = depman.Graph()
+		self.session().update(self.chain(3)[-1], changed=[])
+		self.assertEqual(LOG, ['c1', 'c2'])
+
+	def test_changed_beyond(self):
+		a, b, c = self.chain(3)
+		s = self.session()
+		s.update(c)
+
+		# the descendants of the changed nodes which are not updated are left
+		# out of date
+		KEYS['c0'] = 'new'
+		KEYS['c1'] = 'out'
+		del LOG[:]
+		s.update(b, changed=[a])
+		s.update(c, changed=[])
+		self.assertEqual(LOG, ['c0', 'c1', 'c2'])
+
+class TestFileNode(TestCase):
+	def setUp(self):
+		super(TestFileNode, self).setUp()
+
+		self.path = os.path.join(self.dir, 'src.txt')
+		self.then = time.time() - 10
+
+	def write(self, data, mtime):
+		'''Write data to the file, setting its modification time'''
+
+		open(self.path, 'w').write(data)
+		os.utime(self.path, (mtime, mtime))
+
+	def test_signature(self):
+		self.write('v1', self.then)
+		x = depman.FileNode(self.ex, self.path, payload=payload, 
+			graph=self.graph)
+		s = self.session()
+		s.update(x)
+		self.assertEqual(s.store.get_stat(self.path)[1], 
+			hashlib.md5('v1').hexdigest())
+
+		# the file is not read again while its signature is the same
+		self.write('v2', self.then)
+		self.assertEqual(x.hash(), hashlib.md5('v1').hexdigest())
+
+		self.write('v2', self.then + 1)
+		self.assertEqual(x.hash(), hashlib.md5('v2').hexdigest())
+
+	def test_recent(self):
+		# a file modified within the last second is hashed, but its signature
+		# is not kept
+		self.write('v1', time.time())
+		x = depman.FileNode(self.ex, self.path, payload=payload, 
+			graph=self.graph)
+		s = self.session()
+		s.update(x)
+
+		self.assertEqual(s.store.get(self.path)[0], 
+			hashlib.md5('v1').hexdigest())
+		self.assertEqual(s.store.get_stat(self.path), None)
+
+class TestStores(unittest.TestCase):
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+		self.path = os.path.join(self.dir, '.depman')
+
+	def tearDown(self):
+		shutil.rmtree(self.dir)
+
+	def test_dbm(self):
+		store = depmdb.open(self.path, 'dbm')
+		store.put('b', 'hb', [('a', 'ha'), ('c', 'hc')])
+		store.put('a', 'ha', [])
+		store.put_stat('a', 'sig', 'ha')
+		store.put_time('b', 1.5)
+		store.close()
+
+		store = depmdb.DbmStore(self.path)
+		self.assertEqual(store.get('b'), ('hb', [('a', 'ha'), ('c', 'hc')]))
+		self.assertEqual(store.get_stat('a'), ('sig', 'ha'))
+		self.assertEqual(store.get_time('b'), 1.5)
+		self.assertEqual(store.get('c'), None)
+		self.assertEqual(sorted(store.items()), 
+			[('a', 'ha', []), ('b', 'hb', [('a', 'ha'), ('c', 'hc')])])
+		self.assertEqual(list(store.stat_items()), [('a', 'sig', 'ha')])
+		self.assertEqual(list(store.time_items()), [('b', 1.5)])
+
+		store.delete('b')
+		self.assertFalse('b' in store)
+		self.assertEqual(store.get_time('b'), 1.5)
+		store.close()
+
+	def test_migrate(self):
+		# hash table written by the first versions of depman
+		db = dbm.open(self.path, 'c')
+		db['a'] = 'ha'
+		db['b'] = 'hb,a,ha'
+		db['c'] = 'hc,a,ha,b,hb'
+		db.close()
+
+		store = depmdb.open(self.path)
+		self.assertTrue(isinstance(store, depmdb.SqliteStore))
+		self.assertEqual(store.get('a'), ('ha', []))
+		self.assertEqual(store.get('b'), ('hb', [('a', 'ha')]))
+		self.assertEqual(store.get('c'), ('hc', [('a', 'ha'), ('b', 'hb')]))
+		store.put('a', 'new', [])
+		store.close()
+
+		# the migration is done once, the dbm file is left untouched
+		store = depmdb.open(self.path)
+		self.assertEqual(store.get('a'), ('new', []))
+		store.close()
+
+		db = dbm.open(self.path, 'r')
+		self.assertEqual(db['a'], 'ha')
+		db.close()
+
+class TestWriteBehind(TestCase):
+	def setUp(self):
+		super(TestWriteBehind, self).setUp()
+
+		self.inner = depmdb.SqliteStore(os.path.join(self.dir, 'wb'))
+
+	def tearDown(self):
+		self.inner.close()
+		super(TestWriteBehind, self).tearDown()
+
+	def test_records(self):
+		store = depmdb.WriteBehind(self.inner, records=3, interval=1000)
+		store.put('a', 'ha', [])
+		store.put_time('a', 1.0)
+		self.assertEqual(self.inner.get('a'), None)
+		self.assertEqual(len(store), 2)
+
+		# the third record flushes the buffer
+		store.put_stat('a', 'sig', 'ha')
+		self.assertEqual(len(store), 0)
+		self.assertEqual(self.inner.get('a'), ('ha', []))
+		self.assertEqual(self.inner.get_time('a'), 1.0)
+		self.assertEqual(self.inner.get_stat('a'), ('sig', 'ha'))
+
+	def test_interval(self):
+		store = depmdb.WriteBehind(self.inner, records=1000, interval=0.2)
+		self.assertEqual(store.due(), None)
+
+		store.put('a', 'ha', [])
+		self.assertTrue(0 < store.due() <= 0.2)
+		store.commit()
+		self.assertEqual(self.inner.get('a'), None)
+
+		time.sleep(0.25)
+		self.assertEqual(store.due(), 0)
+		store.commit()
+		self.assertEqual(self.inner.get('a'), ('ha', []))
+		self.assertEqual(store.due(), None)
+
+	def test_reads(self):
+		self.inner.put('b', 'hb', [])
+		store = depmdb.WriteBehind(self.inner)
+		store.put('a', 'ha', [('b', 'hb')])
+		store.put_stat('a', 'sig', 'ha')
+		store.put_time('a', 1.0)
+		store.delete('b')
+
+		# the buffered records are read back before they are flushed
+		self.assertEqual(store.get('a'), ('ha', [('b', 'hb')]))
+		self.assertEqual(store.get_stat('a'), ('sig', 'ha'))
+		self.assertEqual(store.get_time('a'), 1.0)
+		self.assertTrue('a' in store)
+		self.assertFalse('b' in store)
+		self.assertEqual(store.get('b'), None)
+		self.assertEqual(self.inner.get('b'), ('hb', []))
+
+		store.flush()
+		self.assertEqual(self.inner.get('a'), ('ha', [('b', 'hb')]))
+		self.assertEqual(self.inner.get('b'), None)
+
+	def test_completed(self):
+		bad = self.node(nid='bad', payload=failing)
+		child = self.node(bad, 'child', payload=failing)
+		nodes = self.chain(3, payload=failing)
+
+		# keep the nodes written to the buffer, along with whether their 
+		# payload ran by then
+		s = self.session()
+		puts = []
+		put = s.store.put
+		def record(nid, hsh, parents):
+			puts.append((nid, nid in LOG))
+			put(nid, hsh, parents)
+		s.store.put = record
+
+		s.update([child, nodes[-1]], keep_going=True)
+		self.assertEqual(sorted(puts), [('c0', True), ('c1', True), 
+			('c2', True)])
+
+class TestExecutors(unittest.TestCase):
+	def call(self, ex, func, args=(), timeout=None):
+		'''
+		Run func on ex, return the (success, value) it is called back with, 
+		None if it is not called back within 5 seconds
+		'''
+
+		out = []
+		event = threading.Event()
+
+		def callback(x):
+			out.append((True, x))
+			event.set()
+
+		def error_callback(x):
+			out.append((False, x))
+			event.set()
+
+		ex.apply_async(func, args, callback, error_callback, timeout)
+		event.wait(5.0)
+		return out[0] if out else None
+
+	def test_inline_crash(self):
+		ex = depmpp.InlineExecutor()
+		self.assertEqual(self.call(ex, payload, ('x',)), (True, True))
+
+		success, error = self.call(ex, boom)
+		self.assertFalse(success)
+		self.assertTrue('ValueError: boom' in str(error))
+
+	def test_inline_timeout(self):
+		# timeouts are ignored
+		ex = depmpp.InlineExecutor()
+		self.assertEqual(self.call(ex, nap, ('x',), 0.01), (True, True))
+
+	def test_inline_cancel(self):
+		# there is nothing left to cancel, the executor is used again
+		ex = depmpp.InlineExecutor()
+		ex.cancel()
+		self.assertEqual(self.call(ex, payload, ('x',)), (True, True))
+
+	def test_subprocess_crash(self):
+		ex = depmpp.SubprocessExecutor(2)
+		success, error = self.call(ex, die)
+		self.assertFalse(success)
+		self.assertTrue('exited with code 3' in str(error))
+
+		success, error = self.call(ex, boom)
+		self.assertFalse(success)
+		self.assertTrue('ValueError: boom' in str(error))
+
+		# the executor goes on
+		self.assertEqual(self.call(ex, payload, ('x',)), (True, True))
+		ex.close()
+
+	def test_subprocess_timeout(self):
+		ex = depmpp.SubprocessExecutor(2)
+
+		t = time.time()
+		success, error = self.call(ex, sleepy, ('x',), 0.2)
+		self.assertFalse(success)
+		self.assertTrue(isinstance(error, multiprocessing.TimeoutError))
+		self.assertTrue(time.time() - t < 1.0)
+		self.assertEqual(ex._procs, set())
+		ex.close()
+
+	def test_subprocess_cancel(self):
+		ex = depmpp.SubprocessExecutor(1)
+		out = []
+		ex.apply_async(sleepy, ('x',), out.append, out.append)
+		ex.apply_async(payload, ('y',), out.append, out.append)
+		time.sleep(0.5)
+		self.assertEqual(len(ex._procs), 1)
+
+		# the process running is terminated, the queued call is dropped and 
+		# neither is called back
+		ex.cancel()
+		time.sleep(0.5)
+		self.assertEqual(ex._procs, set())
+		self.assertEqual(out, [])
+
+		self.assertEqual(self.call(ex, payload, ('x',)), (True, True))
+		ex.close()
+
+	def test_process_batch(self):
+		ex = depmpp.ProcessExecutor(2)
+		out = []
+		event = threading.Event()
+
+		def callback(i, x):
+			out.append((i, x))
+			if len(out) == 3:
+				event.set()
+
+		ex.apply_batch(echo, [(i,) for i in range(3)], callback)
+		event.wait(5.0)
+		self.assertEqual(sorted(out), [(0, 0), (1, 1), (2, 2)])
+		ex.close()
+
+	def test_process_readers(self):
+		# the threads reading the results of the pools are stopped along with
+		# the pools
+		n = threading.active_count()
+		ex = depmpp.ProcessExecutor(1)
+		for i in range(3):
+			ex.cancel()
+		ex.close()
+
+		t = time.time()
+		while threading.active_count() > n and time.time() - t < 5:
+			time.sleep(0.05)
+		self.assertTrue(threading.active_count() <= n)
+
+	@unittest.skipIf(futures is None, 'futures not installed')
+	def test_futures_crash(self):
+		ex = depmpp.FuturesExecutor(futures.ThreadPoolExecutor(2))
+		success, error = self.call(ex, boom)
+		self.assertFalse(success)
+		self.assertTrue('ValueError: boom' in str(error))
+
+		self.assertEqual(self.call(ex, payload, ('x',)), (True, True))
+		ex.close()
+
+	@unittest.skipIf(futures is None, 'futures not installed')
+	def test_futures_timeout(self):
+		ex = depmpp.FuturesExecutor(futures.ThreadPoolExecutor(2))
+
+		t = time.time()
+		success, error = self.call(ex, sleepy, ('x',), 0.2)
+		self.assertFalse(success)
+		self.assertTrue(isinstance(error, multiprocessing.TimeoutError))
+		self.assertTrue(time.time() - t < 1.0)
+		ex.close()
+
+	@unittest.skipIf(futures is None, 'futures not installed')
+	def test_futures_cancel(self):
+		ex = depmpp.FuturesExecutor(futures.ThreadPoolExecutor(1))
+		out = []
+		ex.apply_async(nap, ('x',), lambda x: out.append('x'))
+		ex.apply_async(payload, ('y',), lambda x: out.append('y'))
+		time.sleep(0.1)
+
+		# the call running is called back, the queued one is cancelled
+		ex.cancel()
+		ex.close()
+		self.assertEqual(out, ['x'])
+		self.assertEqual(LOG, [])
+
+class TestBuild(TestCase):
+	def test_wait(self):
+		nodes = self.chain(3, payload=nap)
+		build = self.session().update_async(nodes[-1])
+		self.assertFalse(build.done())
+		self.assertFalse(build.wait(0.1))
+
+		self.assertTrue(build.wait())
+		self.assertEqual(build.failures, {})
+		self.assertTrue(all([x.is_updated() for x in nodes]))
+
+	def test_one_update(self):
+		s = self.session()
+		build = s.update_async(self.node(payload=nap))
+
+		other = self.node(nid='other')
+		self.assertRaises(RuntimeError, s.update_async, other)
+		self.assertRaises(RuntimeError, s.update, other)
+		self.assertTrue(build.wait())
+
+		# the session is free once the update is done, even if it failed
+		build = s.update_async(self.node(nid='bad', payload=failing))
+		self.assertRaises(RuntimeError, build.wait)
+		s.update(other)
+		self.assertEqual(LOG, ['bad', 'other'])
+
+class TestInterrupt(TestCase):
+	def setUp(self):
+		super(TestInterrupt, self).setUp()
+		self.handler = signal.signal(signal.SIGINT, signal.default_int_handler)
+
+	def tearDown(self):
+		signal.signal(signal.SIGINT, self.handler)
+		super(TestInterrupt, self).tearDown()
+
+	def interrupt(self, func, *args):
+		'''Interrupt func as Ctrl-C does, return the seconds it took to stop'''
+
+		timer = threading.Timer(0.2, os.kill, (os.getpid(), signal.SIGINT))
+		timer.start()
+
+		t = time.time()
+		self.assertRaises(KeyboardInterrupt, func, *args)
+		return time.time() - t
+
+	def test_update(self):
+		x = self.node(payload=sleepy)
+		self.assertTrue(self.interrupt(self.session().update, x) < 1.0)
+
+	def test_build(self):
+		build = self.session().update_async(self.node(payload=sleepy))
+		self.assertTrue(self.interrupt(build.wait) < 1.0)
+		self.assertTrue(build.wait())
+
+class TestResources(TestCase):
+	def test_unlimited(self):
+		# the executor bounds the payloads running at once
+		self.ex = depmpp.ThreadExecutor(8)
+		s = self.session()
+		self.assertEqual(s.resources, {})
+
+		t = time.time()
+		s.update([self.node(payload=nap) for i in range(8)])
+		self.assertTrue(time.time() - t < 0.6)
+
+	def test_capacity(self):
+		self.ex = depmpp.ThreadExecutor(8)
+		s = self.session(resources={'cpu': 2, 'db': 1})
+
+		t = time.time()
+		s.update([self.node(payload=nap) for i in range(4)])
+		self.assertTrue(time.time() - t >= 0.4)
+
+		t = time.time()
+		s.update([self.node(payload=nap, resources={'db': 1}) 
+			for i in range(2)])
+		self.assertTrue(time.time() - t >= 0.4)
+
+class TestFailures(TestCase):
+	def test_raise(self):
+		bad = self.node(nid='bad', payload=failing)
+		self.assertRaises(RuntimeError, self.session().update, bad)
+
+	def test_keep_going(self):
+		bad = self.node(nid='bad', payload=failing)
+		child = self.node(bad, 'child', payload=failing)
+		grand = self.node([child], 'grand', payload=failing)
+		ok = self.node(nid='ok', payload=failing)
+
+		failures = self.session().update([grand, ok], keep_going=True)
+
+		self.assertEqual(failures, {'bad': ['child', 'grand']})
+		self.assertTrue(ok.is_updated())
+		self.assertFalse(any([x.is_updated() for x in [bad, child, grand]]))
+		self.assertTrue('child' not in LOG)
+
+	def test_unhashable(self):
+		KEYS['x'] = IOError(13, 'Permission denied')
+		child = self.node(self.node(nid='x'), 'child')
+		self.assertRaises(IOError, self.session().update, child)
+
+	def test_unhashable_keep_going(self):
+		s = self.session()
+		s.update(self.node(nid='x'))
+
+		# a node which cannot be hashed fails, before or after its payload
+		KEYS['x'] = IOError(13, 'Permission denied')
+		del LOG[:]
+		self.graph = depman.Graph()
+		x = self.node(nid='x')
+		y = self.node(nid='y', payload=spoil)
+		nodes = [self.node(x, 'child'), self.node(y, 'other'), 
+			self.node(nid='ok')]
+
+		failures = s.update(nodes, keep_going=True)
+		self.assertEqual(failures, {'x': ['child'], 'y': ['other']})
+		self.assertEqual(sorted(LOG), ['ok', 'y'])
+		self.assertTrue('Permission denied' in str(x._error))
+
+	def test_unhashable_threads(self):
+		s = self.session(hash_jobs=2)
+		s.update(self.node(nid='x'))
+
+		KEYS['x'] = IOError(13, 'Permission denied')
+		del LOG[:]
+		self.graph = depman.Graph()
+		nodes = [self.node(self.node(nid='x'), 'child'), self.node(nid='ok')]
+
+		failures = s.update(nodes, keep_going=True)
+		self.assertEqual(failures, {'x': ['child']})
+		self.assertEqual(LOG, ['ok'])
+
+	def test_exclusive(self):
+		self.assertRaises(ValueError, self.session().update, self.node(),
+			keep_going=True, fail_fast=True)
+
+	def test_fail_fast(self):
+		self.ex = depmpp.init(2)
+		nodes = [self.node(nid='bad', payload=failing)] + \
+			[self.node(payload=sleepy) for i in range(3)]
+		s = self.session(resources={'cpu': 4})
+		self.assertRaises(RuntimeError, s.update, nodes, fail_fast=True)
+
+		# the sleeping payloads were cancelled, the workers are free
+		self.assertFalse(any([x.is_updated() for x in nodes]))
+		t = time.time()
+		s.update(self.node(payload=payload))
+		self.assertTrue(time.time() - t < 1.0)
+		self.ex.close()
+
+class TestRetries(TestCase):
+	def test_retry(self):
+		x = self.node(nid='x', payload=flaky, attempts=3, backoff=0.01)
+		self.session().update(x)
+
+		self.assertTrue(x.is_updated())
+		self.assertEqual(CALLS['x'], 3)
+
+	def test_backoff(self):
+		# the waits double after each failure
+		x = self.node(nid='x', payload=flaky, attempts=3, backoff=0.2)
+
+		t = time.time()
+		self.session().update(x)
+		self.assertTrue(time.time() - t >= 0.6)
+
+	def test_too_few_attempts(self):
+		x = self.node(nid='x', payload=flaky, attempts=2, backoff=0.01)
+		self.assertRaises(RuntimeError, self.session().update, x)
+		self.assertEqual(CALLS['x'], 2)
+
+	def test_timeout(self):
+		x = self.node(payload=sleepy, timeout=0.1)
+
+		t = time.time()
+		self.assertRaises(RuntimeError, self.session().update, x)
+		self.assertTrue(time.time() - t < 1.0)
+
+class TestBatching(TestCase):
+	def setUp(self):
+		super(TestBatching, self).setUp()
+
+		# count the tasks sent to the executors
+		self.calls = {'chunk': 0, 'chain': 0}
+		self.saved = depman._deliver_chunk, depman._deliver_chain
+
+		def chunk(*args):
+			self.calls['chunk'] += 1
+			return self.saved[0](*args)
+
+		def chain(*args):
+			self.calls['chain'] += 1
+			return self.saved[1](*args)
+
+		depman._deliver_chunk, depman._deliver_chain = chunk, chain
+
+	def tearDown(self):
+		depman._deliver_chunk, depman._deliver_chain = self.saved
+		super(TestBatching, self).tearDown()
+
+	def test_chunks(self):
+		s = self.session(resources={'cpu': 1})
+		s.update([self.node(nid='n%d' % i) for i in range(50)])
+		self.assertEqual(self.calls['chunk'], 0)
+
+		# the payloads are known to be small once they ran
+		for i in range(50):
+			KEYS['n%d' % i] = 'new'
+		del LOG[:]
+		self.graph = depman.Graph()
+		s.update([self.node(nid='n%d' % i) for i in range(50)])
+
+		self.assertEqual(len(LOG), 50)
+		self.assertTrue(0 < self.calls['chunk'] < 50)
+
+	def test_fuse(self):
+		nodes = self.chain(10)
+		self.session(fuse=True).update(nodes[-1])
+
+		self.assertEqual(LOG, ['c%d' % i for i in range(10)])
+		self.assertTrue(all([x.is_updated() for x in nodes]))
+		self.assertEqual(self.calls['chain'], 1)
+
+	def test_fuse_unchanged(self):
+		nodes = self.chain(5)
+		s = self.session(fuse=True)
+		s.update(nodes[-1])
+
+		# the nodes of the chain whose parent hashes the same do not run
+		KEYS['c0'] = 'new'
+		del LOG[:]
+		self.graph = depman.Graph()
+		nodes = self.chain(5)
+		s.update(nodes[-1])
+
+		self.assertEqual(LOG, ['c0', 'c1'])
+		self.assertTrue(all([x.is_updated() for x in nodes]))
+		self.assertEqual(self.calls['chain'], 2)
+
+	def test_fuse_failure(self):
+		nodes = self.chain(5, payload=failing)
+		nodes.append(self.node(nodes[-1], 'bad', payload=failing))
+		nodes.append(self.node(nodes[-1], 'after', payload=failing))
+
+		failures = self.session(fuse=True).update(nodes[-1], keep_going=True)
+		self.assertEqual(failures, {'bad': ['after']})
+		self.assertTrue(nodes[4].is_updated())
+
+	def test_fuse_unpicklable(self):
+		# nodes which cannot be pickled run on their own
+		nodes = self.chain(5)
+		for x in nodes:
+			x.lock = threading.Lock()
+		self.session(fuse=True).update(nodes[-1])
+
+		self.assertEqual(LOG, ['c%d' % i for i in range(5)])
+		self.assertEqual(self.calls['chain'], 0)
+
+	def test_fuse_unloadable(self):
+		# a node class defined after the worker processes were started
+		self.ex = depmpp.init(2)
+		module = sys.modules[KNode.__module__]
+		module.LateNode = type('LateNode', (KNode,), 
+			{'__module__': module.__name__})
+		try:
+			a = module.LateNode(self.ex, nid='a', graph=self.graph)
+			b = module.LateNode(self.ex, a, nid='b', graph=self.graph)
+
+			# the update fails instead of waiting for ever
+			build = self.session(fuse=True).update_async(b)
+			self.assertRaises(RuntimeError, build.wait, 10)
+			self.assertTrue(build.done())
+		finally:
+			del module.LateNode
+			self.ex.close()
+
+class TestDistributed(TestCase):
+	def setUp(self):
+		super(TestDistributed, self).setUp()
+
+		self.ex = depmpp.DistributedExecutor(authkey='test', timeout=2.0)
+		self.workers = [multiprocessing.Process(target=depmpp.run_worker, 
+			args=(self.ex.address, 'test', 2, 0.2)) for i in range(3)]
+		for w in self.workers:
+			w.start()
+
+		t = time.time()
+		while self.ex.capacity() < 6 and time.time() - t < 10:
+			time.sleep(0.05)
+
+	def tearDown(self):
+		self.ex.close()
+		for w in self.workers:
+			w.join(5)
+			if w.is_alive():
+				w.terminate()
+		super(TestDistributed, self).tearDown()
+
+	def test_authkey(self):
+		self.assertRaises(ValueError, depmpp.DistributedExecutor)
+		self.assertRaises(ValueError, depmpp.run_worker, self.ex.address)
+
+	def test_workers(self):
+		nodes = [self.node(nid='n%d' % i, payload=work) for i in range(12)]
+		self.session().update(nodes)
+
+		self.assertTrue(all([x.is_updated() for x in nodes]))
+		pids = set([open(os.path.join(self.dir, x.nid)).read() 
+			for x in nodes])
+		self.assertTrue(len(pids) > 2)
+
+	def test_kill_worker(self):
+		nodes = [self.node(nid='n%d' % i, payload=work) for i in range(12)]
+
+		def kill():
+			time.sleep(0.1)
+			os.kill(self.workers[0].pid, signal.SIGKILL)
+
+		t = threading.Thread(target=kill)
+		t.start()
+		self.session().update(nodes)
+		t.join()
+
+		# the calls of the killed worker ran in the others
+		self.assertTrue(all([x.is_updated() for x in nodes]))
+		self.assertTrue(all([os.path.exists(os.path.join(self.dir, x.nid))
+			for x in nodes]))
+		self.assertEqual(self.ex.capacity(), 4)
+
+class TestCache(TestCase):
+	def test_restore(self):
+		cache = depmcache.Cache(os.path.join(self.dir, 'cache'))
+		s = self.session(cache=cache)
+		src = os.path.join(self.dir, 'src.txt')
+		out = os.path.join(self.dir, 'out.txt')
+
+		def build(data):
+			open(src, 'w').write(data)
+			g = depman.Graph()
+			x = depman.FileNode(self.ex, src, graph=g)
+			s.update(depman.FileNode(self.ex, out, x, payload=upper, graph=g,
+				outputs=[out]))
+			return open(out).read()
+
+		self.assertEqual(build('v1'), 'V1')
+		self.assertEqual(build('v2'), 'V2')
+		self.assertEqual(len(LOG), 2)
+
+		# the outputs of the first version are restored from the cache
+		self.assertEqual(build('v1'), 'V1')
+		self.assertEqual(len(LOG), 2)
+		self.assertEqual(cache.stats()['hits'], 1)
+		cache.close()
+
+	def test_lost_entry(self):
+		cache = depmcache.Cache(os.path.join(self.dir, 'cache'))
+		out = os.path.join(self.dir, 'out.txt')
+		open(out, 'w').write('data')
+
+		self.assertTrue(cache.put('a' * 32, [out]))
+		shutil.rmtree(cache._entry('a' * 32))
+		self.assertFalse(cache.get('a' * 32, [out]))
+
+		# the lost entry is stored again
+		self.assertTrue(cache.put('a' * 32, [out]))
+		os.remove(out)
+		self.assertTrue(cache.get('a' * 32, [out]))
+		self.assertEqual(open(out).read(), 'data')
+		cache.close()
+
+	def test_slow_cache(self):
+		cache = SlowCache(os.path.join(self.dir, 'cache'))
+		out = os.path.join(self.dir, 'out.txt')
+		x = self.node(nid='x', outputs=[out])
+		others = [self.node(nid='n%d' % i) for i in range(4)]
+
+		# the other nodes run while the outputs are looked up
+		self.session(cache=cache).update([x] + others)
+		self.assertEqual(LOG[-2:], ['get', 'x'])
+		self.assertTrue(x.is_updated())
+		cache.close()
+
+class TestRemoteCache(TestCase):
+	def setUp(self):
+		super(TestRemoteCache, self).setUp()
+
+		self.server = depmcache.serve(os.path.join(self.dir, 'server'))
+		self.url = 'http://localhost:%d' % self.server.server_address[1]
+
+	def tearDown(self):
+		self.server.shutdown()
+		self.server.server_close()
+		super(TestRemoteCache, self).tearDown()
+
+	def test_localhost(self):
+		self.assertEqual(self.server.server_address[0], '127.0.0.1')
+
+	def test_share(self):
+		out = os.path.join(self.dir, 'out.txt')
+		open(out, 'w').write('data')
+
+		a = depmcache.RemoteCache(self.url, 
+			depmcache.Cache(os.path.join(self.dir, 'a')))
+		self.assertTrue(a.put('a' * 32, [out]))
+		a.close()
+
+		# the other cache downloads the entry, even while uploads are queued
+		b = SlowUploads(self.url, depmcache.Cache(os.path.join(self.dir, 'b')),
+			jobs=1)
+		b.put('b' * 32, [out])
+		os.remove(out)
+
+		t = time.time()
+		self.assertTrue(b.get('a' * 32, [out]))
+		self.assertTrue(time.time() - t < 0.5)
+		self.assertEqual(open(out).read(), 'data')
+		self.assertEqual(b.stats()['remote_hits'], 1)
+		b.close()
+
+class TestGraph(TestCase):
+	def test_cycle(self):
+		a, b, c = self.chain(3)
+		self.assertRaises(ValueError, a.add_parent, c)
+		self.assertRaises(ValueError, a.add_parent, a)
+		self.assertEqual(a.parents, [])
+
+	def test_order(self):
+		a, b, c = self.chain(3)
+		x = self.node(nid='x')
+		a.add_parent(x)
+
+		order = self.graph.order()
+		self.assertTrue(order.index(x) < order.index(a) < order.index(c))
+		self.assertEqual(self.graph.descendants(x), [a, b, c])
+
+	def test_add_parent_after_update(self):
+		a, b, c = self.chain(3)
+		s = self.session()
+		s.update(c)
+
+		# the new parent has to be updated, along with its descendants
+		x = self.node(nid='x')
+		b.add_parent(x)
+		self.assertTrue(a.is_updated())
+		self.assertFalse(b.is_updated() or c.is_updated())
+
+		# NOTE: c1 hashes the same, so c2 does not run again
+		del LOG[:]
+		s.update(c)
+		self.assertEqual(LOG, ['x', 'c1'])
+		self.assertTrue(c.is_updated())
+
+	def test_clear(self):
+		a, b, c = self.chain(3)
+		ref = weakref.ref(b)
+
+		self.graph.clear()
+		self.assertEqual(len(self.graph), 0)
+		self.assertTrue(a._graph is None)
+
+		del a, b, c
+		gc.collect()
+		self.assertTrue(ref() is None)
+
+		# the graph is used again
+		a, b = self.chain(2)
+		self.assertEqual(b.parents, [a])
+		self.assertEqual(self.graph.order(), [a, b])
+
+	def test_other_graph(self):
+		a = self.node()
+		self.assertRaises(ValueError, self.node, a, graph=depman.Graph())
+
+@unittest.skipIf(depmcsr.numpy is None, 'numpy not installed')
+class TestCSRGraph(unittest.TestCase):
+	def setUp(self):
+		# chain 0 -> 1 -> 2 along with 3, child of 0
+		self.g = depmcsr.CSRGraph.from_edges(4, [0, 1, 0], [1, 2, 3])
+		self.g.digests[:] = ['%032d' % i for i in range(4)]
+
+	def run_nodes(self, idx):
+		'''Run nothing, the digests are left as they are'''
+
+		return self.g.digests[idx]
+
+	def test_structure(self):
+		g = self.g
+		self.assertEqual(list(g.parents(2)), [1])
+		self.assertEqual(list(g.children(0)), [1, 3])
+		self.assertEqual(list(g.in_degree()), [0, 1, 1, 1])
+		self.assertEqual(list(g.levels()), [0, 1, 2, 1])
+		self.assertEqual(list(g.traverse([2])), [0, 1, 2])
+		self.assertEqual(list(depmcsr.numpy.flatnonzero(g.descendants([1]))),
+			[2])
+
+	def test_cycle(self):
+		g = depmcsr.CSRGraph.from_edges(3, [0, 1, 2], [1, 2, 0])
+		self.assertRaises(ValueError, g.levels)
+
+	def test_from_graph(self):
+		graph = depman.Graph()
+		a = depman.Node(None, graph=graph)
+		b = depman.Node(None, a, graph=graph)
+		c = depman.Node(None, [a, b], graph=graph)
+		a.add_parent(depman.Node(None, graph=graph))
+
+		g = depmcsr.CSRGraph.from_graph(graph)
+		for x in graph.nodes:
+			self.assertEqual(list(g.parents(x._idx)), 
+				[y._idx for y in x.parents])
+		self.assertEqual(g.nids, [x.nid for x in graph.nodes])
+
+	def test_update(self):
+		g = self.g
+		self.assertEqual(list(g.update(self.run_nodes)), [0, 1, 3, 2])
+		self.assertEqual(list(g.state), [depmcsr.DONE] * 4)
+
+		# nothing changed
+		g.state[:] = 0
+		self.assertEqual(len(g.update(self.run_nodes)), 0)
+
+		# a changed digest runs the node and its children
+		g.state[:] = 0
+		g.digests[1] = 'x' * 32
+		self.assertEqual(list(g.update(self.run_nodes)), [1, 2])
+
+	def test_propagate(self):
+		g = self.g
+		g.update(self.run_nodes)
+
+		# the dirty nodes done by the earlier update are checked again
+		g.digests[0] = 'x' * 32
+		self.assertEqual(list(g.update(self.run_nodes, changed=[0])), 
+			[0, 1, 3])
+		self.assertEqual(list(g.state), [depmcsr.DONE] * 4)
+		self.assertEqual(g.recorded[0], 'x' * 32)
+
+		# the nodes out of the cone are taken as up to date
+		g.digests[2] = 'y' * 32
+		self.assertEqual(len(g.update(self.run_nodes, changed=[])), 0)
+		self.assertEqual(list(g.update(self.run_nodes, changed=[2])), [2])
+
+	def test_unrecorded(self):
+		g = self.g
+		g.update(self.run_nodes)
+
+		# the node which is not recorded runs, its descendants are checked
+		g.recorded[0] = b''
+		g.state[:] = 0
+		run = lambda idx: depmcsr.numpy.array(['z' * 32] * len(idx), 
+			dtype=g.digests.dtype)
+		self.assertEqual(list(g.update(run, changed=[])), [0, 1, 3, 2])
+		self.assertEqual(list(g.state), [depmcsr.DONE] * 4)
+		self.assertFalse(g.stale(depmcsr.numpy.arange(4)).any())
+
+if __name__ == '__main__':
+	unittest.main()